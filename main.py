@@ -1,11 +1,13 @@
+import time
+_import_started = time.perf_counter()
+
 from typing import Optional, List
-from fastapi import FastAPI, Body
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, Body, Depends, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import os
-from openai import AzureOpenAI
 
 from dotenv import load_dotenv
 from pathlib import Path
@@ -17,17 +19,484 @@ api_key = "sk-ups5H5N5hbV0SZ4M0OnGuA"
 endpoint = "https://aiportalapi.stu-platform.live/jpe"
 deployment_name = "GPT-4o-mini"
 
-client = AzureOpenAI(
-    api_version="2024-07-01-preview",
-    azure_endpoint=endpoint,
-    api_key=api_key,
-)
+# Deployment rẻ hơn cho các call ngắn (tra từ, sinh 1 câu); mặc định dùng chung deployment chính
+lite_deployment_name = os.getenv("AZURE_OPENAI_DEPLOYMENT_LITE", deployment_name)
+
+# Client async để có thể hủy call upstream khi client ngắt kết nối / hết deadline.
+# Tạo lúc cần (hoặc khi warm-up sau startup): riêng import openai đã mất ~150ms lúc khởi động.
+client = None
+
+
+def get_client():
+    global client
+    if client is None:
+        from openai import AsyncAzureOpenAI
+        client = AsyncAzureOpenAI(
+            api_version="2024-07-01-preview",
+            azure_endpoint=endpoint,
+            api_key=api_key,
+        )
+    return client
+
+# --- LLM routing: mỗi endpoint -> deployment + tham số sinh ---
+import asyncio
+import contextvars
+from collections import deque
+
+# max_tokens ở đây là trần (ceiling); giá trị thực tế được tinh chỉnh theo usage quan sát được.
+# lite_ok: endpoint cho phép hạ xuống profile "lite" (giải thích ngắn hơn) khi hệ thống quá tải.
+# timeout: thời gian tối đa (giây) cho 1 call upstream, kể cả khi client không gửi deadline.
+LLM_ROUTES = {
+    "translate":           {"deployment": lite_deployment_name, "max_tokens": 50,   "min_tokens": 16,  "temperature": 0.1,  "lite_ok": False, "timeout": 10},
+    "translate_start":     {"deployment": lite_deployment_name, "max_tokens": 60,   "min_tokens": 24,  "temperature": 1.0,  "lite_ok": False, "timeout": 15},
+    "translate_next":      {"deployment": deployment_name,      "max_tokens": 400,  "min_tokens": 120, "temperature": 0.2,  "lite_ok": True,  "timeout": 30},
+    "translate_batch":     {"deployment": deployment_name,      "max_tokens": 1600, "min_tokens": 300, "temperature": 0.2,  "lite_ok": True,  "timeout": 60},
+    "chat":                {"deployment": deployment_name,      "max_tokens": 600,  "min_tokens": 150, "temperature": 0.2,  "lite_ok": True,  "timeout": 30},
+    "translate_hint":      {"deployment": deployment_name,      "max_tokens": 300,  "min_tokens": 100, "temperature": 0.2,  "lite_ok": True,  "timeout": 30},
+    "quiz_start":          {"deployment": deployment_name,      "max_tokens": 1200, "min_tokens": 400, "temperature": 0.7,  "lite_ok": True,  "timeout": 60},
+    "reading_passage":     {"deployment": deployment_name,      "max_tokens": 700,  "min_tokens": 200, "temperature": 0.8,  "lite_ok": False, "timeout": 45},
+    "listening":           {"deployment": lite_deployment_name, "max_tokens": 60,   "min_tokens": 24,  "temperature": 1.0,  "lite_ok": False, "timeout": 15},
+    "ielts_vocab":         {"deployment": deployment_name,      "max_tokens": 1200, "min_tokens": 300, "temperature": 0.7,  "lite_ok": True,  "timeout": 60},
+    "vocabulary_meanings": {"deployment": deployment_name,      "max_tokens": 1500, "min_tokens": 300, "temperature": 0.05, "lite_ok": False, "timeout": 60},
+}
+
+# "auto": tự hạ xuống lite khi số call đang chạy vượt ngưỡng; "full"/"lite": ép cố định
+LLM_PROFILE = os.getenv("LLM_PROFILE", "auto").lower()
+LLM_LITE_INFLIGHT = int(os.getenv("LLM_LITE_INFLIGHT", "6"))
+LLM_LITE_TOKEN_RATIO = 0.6
+LLM_LITE_SUFFIX = "\nLưu ý: Trả lời thật ngắn gọn, phần giải thích tối đa 2 câu."
+
+# Thống kê completion tokens gần nhất theo từng (endpoint, bucket)
+LLM_USAGE_WINDOW = 200
+LLM_USAGE_MIN_SAMPLES = 20
+LLM_USAGE_HEADROOM = 1.3
+llm_usage = {}
+llm_stats = {
+    "inflight": 0, "calls": 0, "lite_calls": 0, "truncated": 0, "errors": 0,
+    "cancelled_disconnect": 0, "cancelled_deadline": 0,
+}
+llm_cancelled_by_route = {}
+# Prompt tokens theo template@version: tổng số và số token được provider cache (prefix cache hit)
+llm_prompt_cache = {}
+
+# Ngữ cảnh request hiện tại (Request + deadline) để llm_chat biết khi nào nên hủy call
+request_ctx = contextvars.ContextVar("request_ctx", default=None)
+LLM_DISCONNECT_POLL = 0.25
+
+
+class LLMCancelled(Exception):
+    pass
+
+
+async def bind_request_context(request: Request):
+    # Header X-Request-Deadline-Ms: ngân sách thời gian (ms) client còn chờ, tính từ lúc gửi
+    deadline = None
+    header = request.headers.get("x-request-deadline-ms")
+    if header:
+        try:
+            deadline = time.monotonic() + float(header) / 1000
+        except ValueError:
+            pass
+    request_ctx.set({"request": request, "deadline": deadline})
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0
+    idx = min(len(sorted_values) - 1, int(round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _usage_key(route, bucket=None):
+    return f"{route}:{bucket}" if bucket is not None else route
+
+
+def usage_bucket(value, known):
+    # Bucket lấy từ input của client: chỉ giữ giá trị đã biết, còn lại gộp "other"
+    # để llm_usage không phình thêm 1 deque cho mỗi chuỗi lạ
+    return value if value in known else "other"
+
+
+def tuned_max_tokens(route, bucket=None):
+    """
+    max_tokens theo p95 completion tokens đã quan sát (có headroom), kẹp trong [min_tokens, max_tokens]
+    """
+    cfg = LLM_ROUTES[route]
+    samples = llm_usage.get(_usage_key(route, bucket))
+    if not samples or len(samples) < LLM_USAGE_MIN_SAMPLES:
+        return cfg["max_tokens"]
+    p95 = _percentile(sorted(samples), 95)
+    return max(cfg["min_tokens"], min(cfg["max_tokens"], int(p95 * LLM_USAGE_HEADROOM) + 16))
+
+
+def record_llm_usage(route, bucket, completion_tokens, truncated):
+    key = _usage_key(route, bucket)
+    samples = llm_usage.setdefault(key, deque(maxlen=LLM_USAGE_WINDOW))
+    if truncated:
+        # Bị cắt ở giới hạn: số token thật lớn hơn, đẩy mẫu về trần để percentile tăng lại
+        llm_stats["truncated"] += 1
+        samples.append(LLM_ROUTES[route]["max_tokens"])
+    elif completion_tokens:
+        samples.append(completion_tokens)
+
+
+def record_prompt_cache(route, template, usage):
+    key = f"{template}@v{PROMPT_TEMPLATES[template]['version']}" if template else route
+    entry = llm_prompt_cache.setdefault(key, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0})
+    details = getattr(usage, "prompt_tokens_details", None)
+    entry["calls"] += 1
+    entry["prompt_tokens"] += getattr(usage, "prompt_tokens", 0) or 0
+    entry["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+
+def use_lite_profile(route):
+    if not LLM_ROUTES[route]["lite_ok"] or LLM_PROFILE == "full":
+        return False
+    return LLM_PROFILE == "lite" or llm_stats["inflight"] >= LLM_LITE_INFLIGHT
+
+
+async def _await_cancellable(coro, route, request, deadline):
+    """
+    Chờ call upstream; hủy ngay khi client ngắt kết nối hoặc hết deadline
+    """
+    task = asyncio.ensure_future(coro)
+    reason = None
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                reason = "deadline"
+                break
+            done, _ = await asyncio.wait({task}, timeout=min(remaining, LLM_DISCONNECT_POLL))
+            if task in done:
+                return task.result()
+            if request is not None and await request.is_disconnected():
+                reason = "disconnect"
+                break
+    finally:
+        if not task.done():
+            task.cancel()
+    llm_stats[f"cancelled_{reason}"] += 1
+    llm_cancelled_by_route[route] = llm_cancelled_by_route.get(route, 0) + 1
+    print(f"[INFO] LLM call '{route}' cancelled ({reason})")
+    raise LLMCancelled(f"{route} cancelled ({reason})")
+
+
+async def llm_chat(route, system_prompt, user_prompt, bucket=None, template=None, lite=None, **overrides):
+    """
+    Gọi model theo bảng LLM_ROUTES, tự chọn max_tokens và profile (full/lite).
+    Request chia nhiều call song song truyền `lite` đã chọn 1 lần, để các call của chính nó
+    không tự đẩy inflight qua ngưỡng lite
+    """
+    cfg = LLM_ROUTES[route]
+    if lite is None:
+        lite = use_lite_profile(route)
+    max_tokens = overrides.pop("max_tokens", None) or tuned_max_tokens(route, bucket)
+    if lite:
+        max_tokens = max(cfg["min_tokens"], int(max_tokens * LLM_LITE_TOKEN_RATIO))
+        # Đặt ở cuối user message để không phá prefix tĩnh của system prompt
+        user_prompt = user_prompt + LLM_LITE_SUFFIX
+        llm_stats["lite_calls"] += 1
+    params = {
+        "model": lite_deployment_name if lite else cfg["deployment"],
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": cfg["temperature"],
+    }
+    params.update(overrides)
+    ctx = request_ctx.get() or {}
+    deadline = time.monotonic() + cfg["timeout"]
+    if ctx.get("deadline"):
+        deadline = min(deadline, ctx["deadline"])
+    llm_stats["inflight"] += 1
+    llm_stats["calls"] += 1
+    try:
+        with trace_span("llm_call", route=route, model=params["model"], max_tokens=max_tokens) as span:
+            response = await _await_cancellable(
+                get_client().chat.completions.create(**params), route, ctx.get("request"), deadline
+            )
+            if span is not None and getattr(response, "usage", None):
+                span["attrs"]["prompt_tokens"] = getattr(response.usage, "prompt_tokens", 0)
+                span["attrs"]["completion_tokens"] = getattr(response.usage, "completion_tokens", 0)
+    except LLMCancelled:
+        raise
+    except Exception:
+        llm_stats["errors"] += 1
+        raise
+    finally:
+        llm_stats["inflight"] -= 1
+    usage = getattr(response, "usage", None)
+    finish_reason = getattr(response.choices[0], "finish_reason", None) if response.choices else None
+    record_llm_usage(route, bucket, getattr(usage, "completion_tokens", 0), finish_reason == "length")
+    record_prompt_cache(route, template, usage)
+    return response
+
+# --- Prompt templates ---
+# Mỗi endpoint có 1 system prompt tĩnh (byte-identical giữa các request) để provider cache được prefix;
+# mọi phần thay đổi (chủ đề, level, passage, lịch sử, seed...) nằm ở cuối, trong user message.
+# Đổi nội dung system/user thì tăng "version" để thống kê cache tách theo phiên bản.
+PROMPT_TEMPLATES = {
+    "translate": {
+        "version": 2,
+        "system": (
+            "Bạn là từ điển tiếng Anh - Việt chuyên nghiệp. Hãy dịch từ tiếng Anh người dùng đưa ra sang tiếng Việt.\n"
+            "Yêu cầu:\n"
+            "- Trả về nghĩa chính xác nhất, phổ biến nhất\n"
+            "- Nghĩa phải ngắn gọn (1-4 từ), dễ hiểu\n"
+            "- Chỉ trả về nghĩa tiếng Việt, không giải thích thêm\n"
+            "- Nếu là từ rất cơ bản (a, an, the, is, are...) thì trả về nghĩa đơn giản nhất"
+        ),
+        "user": "Dịch từ: {word}",
+    },
+    "translate_start": {
+        "version": 2,
+        "system": (
+            "Bạn là giáo viên tiếng Anh. Hãy tạo ra 1 câu tiếng Việt ngắn gọn, phù hợp để học sinh luyện dịch sang tiếng Anh. "
+            "Câu phải tự nhiên, phù hợp chủ đề, không quá dài, không quá dễ nếu độ khó cao. "
+            "Không được lặp lại bất kỳ câu nào trong danh sách câu đã dùng (nếu có). "
+            "Nếu có đoạn hội thoại hoặc đoạn văn trước đó, hãy nối tiếp mạch nội dung, đảm bảo ngữ cảnh liền mạch. "
+            "Chỉ trả về đúng 1 câu tiếng Việt, không giải thích, không thêm gì khác."
+        ),
+        "user": (
+            "Chủ đề: {topic}. Độ khó: {level}.\n"
+            "Các câu đã dùng (nếu có): {history}\n"
+            "Đoạn trước đó (nếu có):\n{paragraph}\n"
+            "Hãy cho tôi 1 câu tiếng Việt phù hợp. (seed: {seed})"
+        ),
+    },
+    "translate_next": {
+        "version": 2,
+        "system": (
+            "Bạn là giáo viên tiếng Anh. Học sinh đang luyện dịch từng câu theo chủ đề. Hãy sửa câu tiếng Anh học sinh vừa trả lời, chấm điểm (thang 10), nhận xét rõ ràng, và gợi ý diễn đạt tự nhiên hơn. "
+            "Đặc biệt, hãy giải thích rõ cấu trúc ngữ pháp và thì (tense) cần sử dụng trong câu, lý do vì sao lại sửa như vậy. "
+            "Trả lời bằng JSON với 4 trường: user_answer (câu học sinh vừa trả lời), correct_answer (câu đúng), score (điểm, số hoặc chuỗi), explanation (nhận xét, giải thích, gợi ý tự nhiên, trình bày đẹp, có thể xuống dòng, dùng markdown hoặc HTML nếu cần. Đặc biệt, hãy giải thích rõ cấu trúc ngữ pháp và thì (tense) cần sử dụng trong câu, lý do vì sao lại sửa như vậy. ). Ví dụ: {\"user_answer\":..., \"correct_answer\":..., \"score\":..., \"explanation\":...}. Không thêm bất kỳ giải thích nào ngoài JSON."
+        ),
+        "user": "Câu tiếng Việt: {vi_sentence}\nCâu tiếng Anh học sinh trả lời: {user_answer}",
+    },
+    "translate_batch": {
+        "version": 1,
+        "system": (
+            "Bạn là giáo viên tiếng Anh. Học sinh vừa dịch một đoạn văn tiếng Việt sang tiếng Anh, từng câu được đánh số. "
+            "Với MỖI câu, hãy sửa câu tiếng Anh học sinh trả lời, chấm điểm (thang 10) và nhận xét ngắn gọn: lỗi sai, cấu trúc ngữ pháp và thì (tense) cần dùng, gợi ý diễn đạt tự nhiên hơn. "
+            "Giữ mạch ngữ cảnh giữa các câu trong đoạn khi sửa. "
+            "Trả lời bằng một mảng JSON, mỗi câu 1 object với các trường: index (số thứ tự câu như đầu vào), user_answer (câu học sinh trả lời), correct_answer (câu đúng), score (điểm), explanation (nhận xét bằng tiếng Việt, có thể dùng markdown). "
+            "Ví dụ: [{\"index\": 1, \"user_answer\": ..., \"correct_answer\": ..., \"score\": ..., \"explanation\": ...}]. "
+            "Phải có đủ object cho mọi câu. Không thêm bất kỳ giải thích nào ngoài JSON."
+        ),
+        "user": "Chủ đề: {topic}. Độ khó: {level}.\nĐoạn văn gồm {count} câu:\n{items}",
+    },
+    "chat": {
+        "version": 2,
+        "system": (
+            "Bạn là giáo viên tiếng Anh. Hãy sửa câu tiếng Anh của học sinh, chấm điểm (thang 10), nhận xét từng ý rõ ràng (mỗi ý xuống dòng), và cuối cùng hãy gợi ý một cách diễn đạt hay hơn, tự nhiên hơn cho câu của học sinh. "
+            "Trả lời bằng tiếng Việt. Ví dụ:"
+            "\n- Câu đúng: ..."
+            "\n- Điểm: ..."
+            "\n- Nhận xét: ..."
+            "\n- Giải thích: ..."
+            "\n- Gợi ý diễn đạt tự nhiên hơn: ..."
+        ),
+        "user": "{message}",
+    },
+    "translate_hint": {
+        "version": 3,
+        "system": (
+            "Bạn là giáo viên tiếng Anh. Hãy phân tích câu tiếng Việt sau và liệt kê các từ vựng tiếng Anh quan trọng (word), cấu trúc ngữ pháp tiếng Anh cần sử dụng (grammar) để viết đúng câu tiếng Anh tương ứng. "
+            "Mỗi gợi ý là 1 object JSON với các trường: 'word' (từ/cụm từ TIẾNG ANH), 'pos' (từ loại viết tắt: n, v, adj, adv, prep, conj, etc.), 'grammar' (cấu trúc TIẾNG ANH), 'vi' (giải thích ngắn gọn bằng tiếng Việt). "
+            "Ví dụ: [{\"word\": \"dolphin\", \"pos\": \"n\", \"vi\": \"cá heo\"}, {\"word\": \"intelligent\", \"pos\": \"adj\", \"vi\": \"thông minh\"}, {\"grammar\": \"be + adjective\", \"vi\": \"cấu trúc tính từ\"}]. "
+            "Nếu không có gợi ý đặc biệt, trả về mảng rỗng. Chỉ trả về JSON array, không giải thích thêm."
+        ),
+        "user": "Câu tiếng Việt: {vi_sentence}\nHãy trả về JSON array như hướng dẫn.",
+    },
+    "quiz_reading": {
+        "version": 3,
+        "system": (
+            "Bạn là giáo viên luyện thi IELTS. Người dùng sẽ gửi một đoạn đọc hiểu tiếng Anh (Reading passage) và số câu hỏi cần tạo. "
+            "Hãy tạo các câu hỏi trắc nghiệm tiếng Anh theo phong cách đề thi IELTS (dạng Multiple Choice), sát với nội dung đoạn văn, cấu trúc và độ khó của đề thi IELTS thực tế. "
+            "Mỗi câu hỏi phải kiểm tra khả năng đọc hiểu, nắm ý chính, chi tiết, suy luận hoặc từ vựng trong đoạn văn. "
+            "Mỗi câu hỏi gồm: question (nội dung), options (4 đáp án), answer (chỉ số đáp án đúng, bắt đầu từ 0), explain (giải thích ngắn gọn bằng tiếng Việt, nêu lý do chọn đáp án đúng, giải thích bẫy nếu có), evidence (chỉ rõ câu hoặc đoạn trong passage liên quan trực tiếp đến đáp án đúng, chỉ trả về đúng 1 câu hoặc đoạn ngắn nhất có thể, không lặp lại toàn bộ passage). "
+            "Trả về một mảng JSON các object như sau: {question, options, answer, explain, evidence}. Giải thích (explain) phải bằng tiếng Việt. Không giải thích gì ngoài JSON."
+        ),
+        "user": "Reading passage:\n{passage}\n\nHãy sinh {num} câu hỏi quiz.{focus}",
+    },
+    "quiz_general": {
+        "version": 3,
+        "system": (
+            "Bạn là giáo viên luyện thi IELTS. Hãy tạo câu hỏi trắc nghiệm tiếng Anh theo phong cách đề thi IELTS (dạng Multiple Choice), sát với nội dung, cấu trúc, và độ khó của đề thi IELTS thực tế, theo chủ đề, band điểm và số câu người dùng yêu cầu. "
+            "Yêu cầu: Độ khó, từ vựng, cấu trúc ngữ pháp, chủ đề và cách diễn đạt của từng câu hỏi phải tương ứng với band điểm IELTS được yêu cầu. "
+            "Mỗi câu hỏi nên có ngữ cảnh ngắn gọn (nếu cần), nội dung sát với đề thi IELTS (đặc biệt Reading/Listening). "
+            "Mỗi câu hỏi gồm: question (nội dung), options (4 đáp án), answer (chỉ số đáp án đúng, bắt đầu từ 0), explain (giải thích ngắn gọn bằng tiếng Việt, nêu lý do chọn đáp án đúng, giải thích bẫy nếu có). "
+            "Trả về một mảng JSON các object như sau: {question, options, answer, explain}. Giải thích (explain) phải bằng tiếng Việt. Không giải thích gì ngoài JSON."
+        ),
+        "user": "Chủ đề: {topic}. Band điểm IELTS: {level}.\nHãy sinh {num} câu hỏi quiz.{focus}",
+    },
+    "reading_passage": {
+        "version": 2,
+        "system": (
+            "Bạn là Cambridge IELTS examiner. Hãy tạo Reading passage theo chuẩn IELTS Academic với chủ đề, band điểm và độ dài người dùng yêu cầu.\n\n"
+            "YÊU CẦU THEO BAND ĐIỂM:\n"
+            "- Band 1.0-3.5: Văn bản đơn giản, từ vựng cơ bản, câu ngắn, chủ đề quen thuộc hàng ngày\n"
+            "- Band 4.0-5.5: Văn bản trung bình, từ vựng thông dụng, cấu trúc câu đơn giản, chủ đề thực tế\n"
+            "- Band 6.0-7.0: Văn bản phức tạp hơn, từ vựng đa dạng, câu ghép, chủ đề xã hội\n"
+            "- Band 7.5-9.0: Văn phong academic, từ vựng chuyên môn, câu phức, chủ đề khoa học\n\n"
+            "ĐIỀU CHỈNH THEO LEVEL:\n"
+            "- Độ khó từ vựng phù hợp band được yêu cầu\n"
+            "- Cấu trúc câu phù hợp band được yêu cầu\n"
+            "- Độ phức tạp nội dung phù hợp band được yêu cầu\n"
+            "- Giọng văn phù hợp band được yêu cầu (đơn giản → academic)\n\n"
+            "Format: Đoạn văn liền mạch, có đầu - giữa - cuối rõ ràng.\n"
+            "Chỉ trả về passage tiếng Anh, đúng độ dài yêu cầu, không giải thích."
+        ),
+        "user": "Chủ đề: {topic}\nBand điểm: {level}\nĐộ dài: {word_range}\nHãy viết đoạn đọc hiểu IELTS.",
+    },
+    "listening": {
+        "version": 2,
+        "system": (
+            "Bạn là giáo viên luyện thi IELTS. Hãy tạo ra 1 câu tiếng Anh phù hợp để luyện nghe, sát với đề thi IELTS Listening, theo chủ đề và band điểm người dùng yêu cầu. "
+            "Câu phải tự nhiên, không quá dài, không quá dễ nếu band cao. Trả về đúng 1 câu tiếng Anh, không giải thích, không thêm gì khác."
+        ),
+        "user": "Chủ đề: {topic}. Band điểm: {band}.\nHãy cho tôi 1 câu tiếng Anh phù hợp để luyện nghe.",
+    },
+    "ielts_vocab": {
+        "version": 3,
+        "system": (
+            "Bạn là giáo viên luyện thi IELTS. Người dùng sẽ gửi một đoạn đọc hiểu tiếng Anh (Reading passage). "
+            "Hãy phân tích đoạn văn và chỉ trích xuất các từ vựng thực sự phổ biến trong kỳ thi IELTS (high-frequency IELTS vocabulary, academic word list, hoặc các từ thường xuất hiện trong đề thi IELTS band 5-9). "
+            "Bỏ qua các từ thông dụng, từ không phải từ vựng học thuật IELTS. Không chọn các từ như: the, and, is, are, have, do, go, come, get, make, take, see, say, can, will, should, must, may, might, would, could, shall, to, of, in, on, at, for, with, by, from, as, but, or, if, so, because, very, really, just, only, also, too, more, most, much, many, some, any, every, each, all, no, not, nor, neither, either, both, few, little, less, least, enough, again, always, never, sometimes, often, usually, rarely, seldom, ever, never, before, after, then, now, soon, later, today, tomorrow, yesterday, here, there, where, when, why, how, what, which, who, whom, whose, this, that, these, those, I, you, he, she, it, we, they, me, him, her, us, them, my, your, his, her, its, our, their, mine, yours, hers, ours, theirs, a, an. "
+            "Chỉ chọn các từ academic, collocation, hoặc technical thường gặp trong đề IELTS. "
+            "Với mỗi từ vựng, hãy trả về thông tin sau: word (từ), meaning (nghĩa tiếng Việt), part_of_speech (loại từ), example (ví dụ sử dụng từ trong ngữ cảnh đoạn văn), analysis (giải thích ngắn gọn về ý nghĩa/ngữ cảnh sử dụng từ trong đoạn). "
+            "Chỉ trả về một mảng JSON các object như sau: {word, meaning, part_of_speech, example, analysis}. Không giải thích gì ngoài JSON."
+        ),
+        "user": "Reading passage:\n{passage}\n\nHãy trích xuất từ vựng IELTS từ đoạn văn trên.",
+    },
+    "vocabulary_meanings": {
+        "version": 2,
+        "system": (
+            "Bạn là từ điển Cambridge Dictionary chuyên nghiệp. Người dùng sẽ gửi một đoạn văn và danh sách từ cần dịch.\n"
+            "Dịch CHÍNH XÁC từng từ trong danh sách sang tiếng Việt theo ngữ cảnh đoạn văn.\n\n"
+            "QUAN TRỌNG: JSON phải có đủ entry cho MỌI từ trong danh sách, không được thiếu!\n\n"
+            "Format: {\"word1\":\"nghĩa\", \"word2\":\"nghĩa\", ...}\n\n"
+            "Quy tắc dịch:\n"
+            "- Từ nội dung: dịch theo nghĩa chính xác trong ngữ cảnh\n"
+            "- Từ ngữ pháp (the, and, is, are...): dịch nghĩa đơn giản nhất\n"
+            "- Nghĩa ngắn gọn 1-3 từ\n"
+            "- Bắt buộc phải có đủ tất cả từ trong response\n"
+            "- Chỉ trả JSON, không giải thích"
+        ),
+        "user": (
+            "Đoạn văn:\n\n{passage}\n\n"
+            "Dịch tất cả {count} từ sau (JSON phải có ĐÚNG {count} entries):\n{words}"
+        ),
+    },
+}
+
+import hashlib
+for _name, _tpl in PROMPT_TEMPLATES.items():
+    _tpl["prefix_hash"] = hashlib.sha1(_tpl["system"].encode("utf-8")).hexdigest()[:10]
+
+
+def render_prompt(name, **variables):
+    """
+    Trả về (system_prompt, user_prompt): system giữ nguyên bản tĩnh, biến chỉ điền vào user
+    """
+    tpl = PROMPT_TEMPLATES[name]
+    return tpl["system"], tpl["user"].format(**variables)
+
+
+# --- Request tracing / profiling ---
+# Bật theo từng request bằng header "X-Trace: 1" (chỉ span) hoặc "X-Trace: profile" (kèm profiler),
+# hoặc lấy mẫu ngẫu nhiên theo TRACE_SAMPLE_RATE. Xem kết quả tại /admin/traces (chỉ truy cập local).
+import functools
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from fastapi.routing import APIRoute
+
+Profiler = None  # pyinstrument.Profiler, import khi có request profile đầu tiên
+
+
+def _profiler_class():
+    global Profiler
+    if Profiler is None:
+        try:
+            from pyinstrument import Profiler  # sampling profiler, nếu có cài
+        except ImportError:
+            Profiler = False
+    return Profiler or None
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_BUFFER_SIZE = 200
+trace_buffer = deque(maxlen=TRACE_BUFFER_SIZE)
+current_span = contextvars.ContextVar("current_span", default=None)
+
+
+def _new_span(name, **attrs):
+    return {"name": name, "start": time.perf_counter(), "end": None, "attrs": attrs, "children": []}
+
+
+@contextmanager
+def trace_span(name, **attrs):
+    """
+    Ghi 1 span con của span hiện tại; không làm gì nếu request không được trace
+    """
+    parent = current_span.get()
+    if parent is None:
+        yield None
+        return
+    span = _new_span(name, **attrs)
+    parent["children"].append(span)
+    token = current_span.set(span)
+    try:
+        yield span
+    finally:
+        span["end"] = time.perf_counter()
+        current_span.reset(token)
+
+
+def _span_to_dict(span, origin):
+    return {
+        "name": span["name"],
+        "start_ms": round((span["start"] - origin) * 1000, 2),
+        "duration_ms": round(((span["end"] or span["start"]) - span["start"]) * 1000, 2),
+        **({"attrs": span["attrs"]} if span["attrs"] else {}),
+        "children": [_span_to_dict(child, origin) for child in span["children"]],
+    }
+
+
+def traced_endpoint(endpoint):
+    # Bọc hàm xử lý để tách thời gian handler khỏi phần validate request / serialize response
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        with trace_span("handler", endpoint=endpoint.__name__):
+            return await endpoint(*args, **kwargs)
+    return wrapper
+
+
+class TracedRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            endpoint = traced_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    # Không chặn startup: cache được làm nóng nền (warm_caches), request đến sớm tự nạp lazy
+    task = asyncio.create_task(warm_caches())
+    yield
+    task.cancel()
+
+
+app = FastAPI(dependencies=[Depends(bind_request_context)], lifespan=lifespan)
+app.router.route_class = TracedRoute
 
 # Mount static directory for frontend
 import os
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Dữ liệu app tự ghi khi chạy (không commit): đặt RUNTIME_DATA_DIR ra volume riêng khi deploy
+RUNTIME_DATA_DIR = os.getenv("RUNTIME_DATA_DIR", os.path.join(BASE_DIR, "runtime"))
 STATIC_DIR = os.path.join(BASE_DIR, "static")
 if not os.path.exists(STATIC_DIR):
     os.makedirs(STATIC_DIR)
@@ -41,6 +510,147 @@ async def root():
     # fallback: if not found, show error
     return {"error": "index.html not found in static/"}
 
+class TraceMiddleware:
+    """
+    ASGI middleware thuần: không bọc `receive`, nên request.is_disconnected() vẫn thấy
+    http.disconnect và llm_chat hủy được call upstream khi client ngắt kết nối
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global profile_active
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        path = scope["path"]
+        headers = dict(scope["headers"])
+        mode = headers.get(b"x-trace", b"").decode("latin-1").lower()
+        if path.startswith("/admin") or (not mode and random.random() >= TRACE_SAMPLE_RATE):
+            return await self.app(scope, receive, send)
+        trace_id = uuid.uuid4().hex[:12]
+        status = {"code": 500}
+
+        async def send_with_trace_id(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-trace-id", trace_id.encode())]
+            await send(message)
+
+        root = _new_span("request", method=scope["method"], path=path)
+        root["started_at"] = time.time()  # giờ thật lúc bắt đầu request (start chỉ là perf_counter)
+        token = current_span.set(root)
+        profiler = None
+        profile_note = None
+        if mode == "profile":
+            # cProfile / pyinstrument gắn theo thread, event loop chỉ có 1 thread: mỗi lúc 1 request profile
+            if profile_active:
+                profile_note = "(bỏ qua profiler: đang có request profile khác)"
+            else:
+                profile_active = True
+                if _profiler_class() is not None:
+                    profiler = Profiler(async_mode="disabled")
+                    profiler.start()
+                else:
+                    import cProfile
+                    profiler = cProfile.Profile()
+                    profiler.enable()
+        try:
+            await self.app(scope, receive, send_with_trace_id)
+        finally:
+            root["end"] = time.perf_counter()
+            current_span.reset(token)
+            if profiler is not None:
+                if _profiler_class() is not None:
+                    profiler.stop()
+                else:
+                    profiler.disable()
+                profile_active = False
+            self.record(trace_id, path, status["code"], mode, root, profiler, profile_note)
+
+    @staticmethod
+    def record(trace_id, path, status_code, mode, root, profiler, profile_note):
+        # Phần ngoài handler: đọc + validate request body, validate + serialize response_model
+        handler = next((child for child in root["children"] if child["name"] == "handler"), None)
+        if handler and handler["end"]:
+            root["children"].insert(0, {**_new_span("validate_request"), "start": root["start"], "end": handler["start"]})
+            root["children"].append({**_new_span("validate_serialize_response"), "start": handler["end"], "end": root["end"]})
+        trace = {
+            "id": trace_id,
+            "path": path,
+            "status": status_code,
+            "started_at": root["started_at"],
+            "duration_ms": round((root["end"] - root["start"]) * 1000, 2),
+            "sampled": not mode,
+            "spans": _span_to_dict(root, root["start"]),
+        }
+        if profiler is not None:
+            if _profiler_class() is not None:
+                trace["profile"] = profiler.output_text(unicode=True)
+            else:
+                import io
+                import pstats
+                out = io.StringIO()
+                pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(40)
+                trace["profile"] = out.getvalue()
+        elif profile_note:
+            trace["profile"] = profile_note
+        trace_buffer.append(trace)
+
+
+profile_active = False
+app.add_middleware(TraceMiddleware)
+
+def _require_local(request: Request):
+    if request.client is None or request.client.host not in ("127.0.0.1", "::1", "localhost"):
+        raise HTTPException(status_code=403, detail="Admin endpoint chỉ truy cập từ localhost")
+
+@app.get("/admin/traces")
+async def list_traces(request: Request, path: Optional[str] = None, limit: int = 50):
+    _require_local(request)
+    traces = [t for t in reversed(trace_buffer) if path is None or t["path"] == path][:limit]
+    return {
+        "traces": [
+            {key: t[key] for key in ("id", "path", "status", "started_at", "duration_ms", "sampled")}
+            for t in traces
+        ]
+    }
+
+@app.get("/admin/traces/{trace_id}")
+async def get_trace(trace_id: str, request: Request):
+    _require_local(request)
+    for trace in trace_buffer:
+        if trace["id"] == trace_id:
+            return trace
+    raise HTTPException(status_code=404, detail="Không tìm thấy trace")
+
+@app.get("/api/llm-stats")
+async def llm_stats_endpoint(request: Request):
+    _require_local(request)
+    # Xem nhanh routing, max_tokens đang dùng và percentiles completion tokens
+    usage = {}
+    for key, samples in llm_usage.items():
+        ordered = sorted(samples)
+        usage[key] = {
+            "samples": len(ordered),
+            "p50": _percentile(ordered, 50),
+            "p95": _percentile(ordered, 95),
+            "max": ordered[-1] if ordered else 0,
+        }
+    routes = {
+        name: {**cfg, "tuned_max_tokens": tuned_max_tokens(name), "lite": use_lite_profile(name)}
+        for name, cfg in LLM_ROUTES.items()
+    }
+    return {
+        "profile": LLM_PROFILE,
+        "stats": llm_stats,
+        "cancelled_by_route": llm_cancelled_by_route,
+        "prompt_cache": llm_prompt_cache,
+        "templates": {name: {"version": tpl["version"], "prefix_hash": tpl["prefix_hash"]} for name, tpl in PROMPT_TEMPLATES.items()},
+        "routes": routes,
+        "usage": usage,
+    }
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -58,62 +668,350 @@ class TranslateStartRequest(BaseModel):
     level: str
     prev_history: list = []
     paragraph: list = []  # Danh sách các câu song ngữ đã dịch (nếu có)
+    session_id: Optional[str] = None  # ID phiên luyện dịch, dùng để không lặp câu offline
 
 class TranslateNextRequest(BaseModel):
     topic: str
     level: str
     prev_history: list
     user_answer: str
+    session_id: Optional[str] = None
 
 class TranslateResponse(BaseModel):
     vi_sentence: str
     feedback: Optional[str] = None
+
+class TranslatePair(BaseModel):
+    vi: str
+    en: str = ""
+
+class TranslateBatchRequest(BaseModel):
+    pairs: List[TranslatePair]
+    topic: str = ""
+    level: str = ""
+
+class TranslateGrade(BaseModel):
+    index: int
+    vi_sentence: str
+    user_answer: str
+    correct_answer: str = ""
+    score: Optional[str] = None
+    explanation: str = ""
+
+class TranslateBatchResponse(BaseModel):
+    results: List[TranslateGrade]
 import random
+import re
+
+# --- Offline sentence corpus ---
+# Câu luyện dịch mẫu theo (topic, tier), đọc từ data/translate_corpus.tsv (cột: topic, level, sentence).
+# Tất cả câu nằm trong 1 tuple phẳng; mỗi (topic, tier) là 1 khoảng [start, stop) liền nhau.
+# Mỗi phiên luyện dịch giữ 1 bitset (int) các câu đã phát, nên chọn câu mới tốn O(1) kỳ vọng
+# thay vì lọc lại cả danh sách theo prev_history.
+# translate_corpus.tsv chỉ là bộ câu khởi đầu; câu AI sinh cho /translate/start (không có ngữ cảnh
+# đoạn trước) được ghi thêm vào RUNTIME_DATA_DIR/translate_corpus_learned.tsv và nạp lại ở lần
+# khởi động sau, nên corpus offline lớn dần theo traffic thực. Chỉ học cho các (topic, tier) đã có
+# trong file gốc, nên số nhóm (và kích thước file) bị chặn bởi CORPUS_GROUP_MAX * số nhóm gốc.
+from collections import OrderedDict
+
+CORPUS_PATH = os.path.join(BASE_DIR, "data", "translate_corpus.tsv")
+CORPUS_LEARNED_PATH = os.path.join(RUNTIME_DATA_DIR, "translate_corpus_learned.tsv")
+CORPUS_GROUP_MAX = 4000  # số câu tối đa mỗi (topic, tier), giữ bitset session nhỏ
+CORPUS_MAX_SESSIONS = 20000
+CORPUS_RANDOM_PROBES = 8
+# OFFLINE_MODE=1: sinh câu luyện dịch hoàn toàn từ corpus, không gọi AI
+OFFLINE_MODE = os.getenv("OFFLINE_MODE", "0") == "1"
+
+corpus_loaded = False
+corpus_sentences = ()
+corpus_index = {}  # (topic, tier) -> (start, stop)
+corpus_ids = {}  # câu -> vị trí trong corpus_sentences
+corpus_sessions = OrderedDict()  # session_id -> {(topic, tier): bitset tương đối với start}
+corpus_learned = {}  # (topic, tier) -> số câu đã ghi thêm trong process này
+corpus_seed_groups = set()  # (topic, tier) có trong translate_corpus.tsv
+# Câu tiếng Việt hợp lệ phải có ít nhất 1 ký tự có dấu; output tiếng Anh/lời từ chối bị loại
+CORPUS_VI_CHARS = re.compile(r"[ăâđêôơưáàảãạấầẩẫậắằẳẵặéèẻẽẹếềểễệíìỉĩịóòỏõọốồổỗộớờởỡợúùủũụứừửữựýỳỷỹỵ]", re.I)
+CORPUS_REJECT_MARKERS = (
+    "xin lỗi", "sorry", "as an ai", "mô hình ngôn ngữ", "không thể tạo", "tiếng việt:", "tiếng anh:", "câu:"
+)
+CORPUS_SENTENCE_WORDS = (3, 40)
 
-# Dữ liệu mẫu cho các chủ đề/mức độ
-TRANSLATE_DATA = {
-    'travel': {
-        'easy': [
-            'Tôi muốn đặt một phòng khách sạn.',
-            'Bạn có thể chỉ đường đến sân bay không?',
-            'Tôi thích đi du lịch bằng tàu hỏa.'
-        ],
-        'medium': [
-            'Tôi đã từng bị lạc khi đi du lịch ở nước ngoài.',
-            'Bạn có thể giới thiệu một nhà hàng địa phương nổi tiếng không?',
-            'Tôi muốn trải nghiệm văn hóa bản địa khi đi du lịch.'
-        ],
-        'hard': [
-            'Việc chuẩn bị hành lý kỹ càng giúp chuyến đi suôn sẻ hơn.',
-            'Tôi muốn tìm hiểu về lịch sử và phong tục của nơi tôi đến.',
-            'Bạn nghĩ điều gì là khó khăn nhất khi du lịch nước ngoài?' 
-        ]
-    },
-    'school': {
-        'easy': [
-            'Tôi đi học bằng xe đạp.',
-            'Môn học yêu thích của tôi là tiếng Anh.',
-            'Tôi có nhiều bạn ở trường.'
-        ],
-        'medium': [
-            'Tôi thường làm bài tập về nhà vào buổi tối.',
-            'Giáo viên của tôi rất thân thiện và nhiệt tình.',
-            'Tôi muốn tham gia câu lạc bộ tiếng Anh.'
-        ],
-        'hard': [
-            'Việc học nhóm giúp tôi hiểu bài nhanh hơn.',
-            'Tôi nghĩ rằng kỹ năng thuyết trình rất quan trọng trong học tập.',
-            'Bạn có thể chia sẻ kinh nghiệm học tập hiệu quả không?'
-        ]
-    },
-    # ... các chủ đề khác tương tự ...
-}
+
+def level_tier(level):
+    # Frontend gửi band IELTS ("1.0".."9.0"); corpus chia 3 mức easy/medium/hard
+    if level in ("easy", "medium", "hard"):
+        return level
+    try:
+        band = float(level)
+    except (TypeError, ValueError):
+        return "medium"
+    if band <= 4.0:
+        return "easy"
+    if band <= 6.5:
+        return "medium"
+    return "hard"
+
+
+def load_translate_corpus(paths=(CORPUS_PATH, CORPUS_LEARNED_PATH)):
+    global corpus_sentences, corpus_loaded
+    groups = {}
+    for i, path in enumerate(paths):
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            next(f, None)  # header
+            for line in f:
+                parts = line.rstrip("\n").split("\t")
+                if len(parts) != 3 or not parts[2]:
+                    continue
+                key = (parts[0], parts[1])
+                # File đầu là corpus gốc; các file sau chỉ bổ sung cho nhóm đã có trong file gốc
+                if i > 0 and key not in groups:
+                    continue
+                # dict giữ thứ tự và bỏ câu trùng giữa file gốc và file learned
+                group = groups.setdefault(key, {})
+                if len(group) < CORPUS_GROUP_MAX:
+                    group[parts[2]] = None
+        if i == 0:
+            corpus_seed_groups.clear()
+            corpus_seed_groups.update(groups)
+    sentences = []
+    corpus_index.clear()
+    for key, items in groups.items():
+        corpus_index[key] = (len(sentences), len(sentences) + len(items))
+        sentences.extend(items)
+    corpus_sentences = tuple(sentences)
+    corpus_ids.clear()
+    corpus_ids.update((sentence, idx) for idx, sentence in enumerate(corpus_sentences))
+    corpus_learned.clear()
+    corpus_loaded = True
+    print(f"[DEBUG] Translate corpus loaded: {len(corpus_sentences)} sentences, {len(corpus_index)} groups")
+
+
+def ensure_translate_corpus():
+    if not corpus_loaded:
+        load_translate_corpus()
+
+
+def corpus_sentence_ok(sentence):
+    # Lọc output hỏng trước khi đưa vào corpus: lời từ chối, tiếng Anh, câu quá ngắn/dài
+    words = sentence.split()
+    if not CORPUS_SENTENCE_WORDS[0] <= len(words) <= CORPUS_SENTENCE_WORDS[1]:
+        return False
+    if sentence[-1] not in ".?!" or not CORPUS_VI_CHARS.search(sentence):
+        return False
+    lowered = f" {sentence.lower()} "
+    return not any(marker in lowered for marker in CORPUS_REJECT_MARKERS)
+
+
+def learn_corpus_sentence(topic, level, sentence):
+    """
+    Ghi câu AI vừa sinh vào file corpus learned (dùng từ lần khởi động sau)
+    """
+    ensure_translate_corpus()
+    sentence = " ".join((sentence or "").split()).strip('"“”')
+    if not sentence or "\t" in sentence or sentence in corpus_ids:
+        return
+    key = (topic.strip(), level_tier(level))
+    # topic do client gửi: chỉ học cho nhóm có sẵn trong corpus gốc, không mở nhóm mới
+    if key not in corpus_seed_groups or not corpus_sentence_ok(sentence):
+        return
+    start, stop = corpus_index.get(key, (0, 0))
+    if stop - start + corpus_learned.get(key, 0) >= CORPUS_GROUP_MAX:
+        return
+    corpus_learned[key] = corpus_learned.get(key, 0) + 1
+    corpus_ids.setdefault(sentence, -1)  # chặn ghi trùng trong process này
+    try:
+        os.makedirs(RUNTIME_DATA_DIR, exist_ok=True)
+        new_file = not os.path.exists(CORPUS_LEARNED_PATH)
+        with open(CORPUS_LEARNED_PATH, "a", encoding="utf-8") as f:
+            if new_file:
+                f.write("topic\tlevel\tsentence\n")
+            f.write(f"{key[0]}\t{key[1]}\t{sentence}\n")
+    except OSError as e:
+        print("[ERROR] learn_corpus_sentence:", e)
+
+
+def sample_corpus_sentence(topic, level, session_id=None, prev_history=None, mark=True):
+    """
+    Lấy ngẫu nhiên 1 câu chưa dùng của (topic, level); None nếu đã hết câu.
+    mark=False chỉ xem trước, không đánh dấu câu là đã dùng trong session
+    """
+    ensure_translate_corpus()
+    key = (topic, level_tier(level))
+    if key not in corpus_index:
+        return None
+    start, stop = corpus_index[key]
+    size = stop - start
+    session = None
+    if session_id:
+        session = corpus_sessions.setdefault(session_id, {})
+        corpus_sessions.move_to_end(session_id)
+        while len(corpus_sessions) > CORPUS_MAX_SESSIONS:
+            corpus_sessions.popitem(last=False)
+        used = session.get(key, 0)
+    else:
+        # Không có session: dựng bitset từ lịch sử client gửi lên (O(len(history)))
+        used = 0
+        for sentence in prev_history or []:
+            idx = corpus_ids.get(sentence)
+            if idx is not None and start <= idx < stop:
+                used |= 1 << (idx - start)
+    full = (1 << size) - 1
+    free = ~used & full
+    if not free:
+        # Đã phát hết câu của nhóm: bắt đầu vòng mới thay vì dừng phiên luyện
+        used, free = 0, full
+    for _ in range(CORPUS_RANDOM_PROBES):
+        offset = random.randrange(size)
+        if free >> offset & 1:
+            break
+    else:
+        # Còn ít câu trống: xoay bitset 1 đoạn ngẫu nhiên rồi lấy bit trống thấp nhất
+        shift = random.randrange(size)
+        rotated = ((free >> shift) | (free << (size - shift))) & full
+        offset = ((rotated & -rotated).bit_length() - 1 + shift) % size
+    if session is not None and mark:
+        session[key] = used | (1 << offset)
+    return corpus_sentences[start + offset]
+
+
+# --- Pronunciation lookup ---
+import re
+
+# Phiên âm IPA (giọng Anh-Anh) tra từ data/ipa_dict.tsv thay vì để model sinh: dữ liệu tĩnh,
+# tra O(1), không tốn output token. Từ không có trong bộ soạn tay thì tra data/ipa_cmudict.tsv
+# (~33k từ thông dụng chuyển từ CMUdict sang IPA kiểu Anh-Anh, bỏ âm r cuối âm tiết;
+# giấy phép CMUdict ở data/LICENSE-cmudict).
+# Dạng biến đổi (-s, -ed, -ing, -ly...) của từ vẫn chưa có thì suy ra từ từ gốc.
+IPA_PATH = os.path.join(BASE_DIR, "data", "ipa_dict.tsv")
+IPA_FALLBACK_PATH = os.path.join(BASE_DIR, "data", "ipa_cmudict.tsv")
+ipa_dict = {}
+ipa_loaded = False
+
+_IPA_VOICELESS = ("p", "t", "k", "f", "θ")
+_IPA_SIBILANTS = ("s", "z", "ʃ", "ʒ", "tʃ", "dʒ")
+
+
+def load_ipa_dict(paths=(IPA_PATH, IPA_FALLBACK_PATH)):
+    global ipa_loaded
+    ipa_dict.clear()
+    ipa_loaded = True
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding="utf-8") as f:
+            next(f, None)  # header
+            for line in f:
+                word, _, ipa = line.rstrip("\n").partition("\t")
+                # File đứng trước (bộ soạn tay) được ưu tiên
+                if word and ipa and word not in ipa_dict:
+                    ipa_dict[word] = ipa.strip("/")
+    print(f"[DEBUG] IPA dictionary loaded: {len(ipa_dict)} words")
+
+
+def ensure_ipa_dict():
+    if not ipa_loaded:
+        load_ipa_dict()
+
+
+def _ipa_plural(ipa):
+    if ipa.endswith(_IPA_SIBILANTS):
+        return ipa + "ɪz"
+    return ipa + ("s" if ipa.endswith(_IPA_VOICELESS) else "z")
+
+
+def _ipa_past(ipa):
+    if ipa.endswith(("t", "d")):
+        return ipa + "ɪd"
+    return ipa + ("t" if ipa.endswith(_IPA_VOICELESS + ("s", "ʃ", "tʃ")) else "d")
+
+
+def _ipa_inflected(word):
+    # (hậu tố chính tả, các cách khôi phục từ gốc, hàm ghép phiên âm).
+    # Từ gốc phải dài từ 3 chữ cái để không đoán bừa (shed != she + ed)
+    rules = (
+        ("ies", ("y",), lambda ipa: ipa + "z"),
+        ("es", ("e", ""), _ipa_plural),
+        ("s", ("",), _ipa_plural),
+        ("ied", ("y",), lambda ipa: ipa + "d"),
+        ("ed", ("e", "", "-"), _ipa_past),
+        ("ing", ("e", "", "-"), lambda ipa: ipa + "ɪŋ"),
+        ("ily", ("y",), lambda ipa: ipa[:-1] + "ɪli"),
+        ("ly", ("",), lambda ipa: ipa + "li"),
+        ("ment", ("",), lambda ipa: ipa + "mənt"),
+        ("ness", ("",), lambda ipa: ipa + "nəs"),
+    )
+    for suffix, restores, combine in rules:
+        if not word.endswith(suffix) or len(word) - len(suffix) < 3:
+            continue
+        stem = word[:-len(suffix)]
+        for restore in restores:
+            # "-": phụ âm cuối bị gấp đôi (stopped -> stop)
+            if restore == "-":
+                # bỏ "rr" (herring != her + ing): các từ như referring đã có sẵn trong từ điển
+                base = stem[:-1] if len(stem) > 3 and stem[-1] == stem[-2] != "r" else None
+            elif suffix == "es" and restore == "" and not stem.endswith(("s", "x", "z", "ch", "sh")):
+                base = None  # -es chỉ thêm sau âm xuýt (watches); notes = note + s
+            else:
+                base = stem + restore
+            if base and base in ipa_dict:
+                ipa = ipa_dict[base]
+                if suffix == "ing" and base.endswith("r") and not ipa.endswith("r"):
+                    ipa += "r"  # âm r nối trước nguyên âm (glimmering)
+                return combine(ipa)
+    return None
+
+
+def lookup_ipa(text):
+    """
+    Phiên âm IPA dạng "/.../" cho 1 từ hoặc cụm từ; "" nếu không tra được
+    """
+    words = re.findall(r"[a-z]+", (text or "").lower())
+    if not words:
+        return ""
+    ensure_ipa_dict()
+    parts = []
+    for word in words:
+        ipa = ipa_dict.get(word) or _ipa_inflected(word)
+        if ipa is None:
+            return ""
+        parts.append(ipa)
+    return "/" + " ".join(parts) + "/"
+
+
+# --- Word cache ---
+# Nghĩa từ đã có (tra hover, từ vựng passage, IELTS vocab) giữ lại để lần tra sau và bộ ôn tập
+# của learner dùng luôn, không gọi model lại.
+WORD_CACHE_SIZE = 20000
+word_cache = OrderedDict()  # word (lowercase) -> {"meaning", "part_of_speech", "example"}
+
+
+def cache_word(word, meaning, part_of_speech="", example="", overwrite=True):
+    key = (word or "").strip().lower()
+    if not key or not meaning or not isinstance(meaning, str):
+        return
+    if key in word_cache and not overwrite:
+        return
+    word_cache[key] = {"meaning": meaning, "part_of_speech": part_of_speech, "example": example}
+    word_cache.move_to_end(key)
+    while len(word_cache) > WORD_CACHE_SIZE:
+        word_cache.popitem(last=False)
+
+
+def cached_word(word):
+    key = (word or "").strip().lower()
+    data = word_cache.get(key)
+    if data is not None:
+        word_cache.move_to_end(key)
+    return data
 
 # Simple word translation endpoint for hover tooltips
 class SimpleTranslateRequest(BaseModel):
     text: str
     topic: str = "vocabulary"
     level: str = "basic"
+    learner_id: Optional[str] = None  # Có thì từ được đưa vào hàng đợi ôn tập của learner
 
 class TranslateHint(BaseModel):
     word: str
@@ -140,25 +1038,17 @@ async def translate_word(req: SimpleTranslateRequest):
             print("[ERROR] /translate empty word")
             return {"hints": []}
         
+        if req.learner_id:
+            update_learner(req.learner_id, lambda rec: schedule_word(rec, word))
+        
+        cached = cached_word(word)
+        if cached:
+            return {"hints": [TranslateHint(word=word, meaning=cached["meaning"], pronunciation="", type="vocabulary")]}
+        
         # Simple word translation using AI
-        system_prompt = (
-            f"Bạn là từ điển tiếng Anh - Việt chuyên nghiệp. Hãy dịch từ '{word}' sang tiếng Việt.\n"
-            "Yêu cầu:\n"
-            "- Trả về nghĩa chính xác nhất, phổ biến nhất\n"
-            "- Nghĩa phải ngắn gọn (1-4 từ), dễ hiểu\n"
-            "- Chỉ trả về nghĩa tiếng Việt, không giải thích thêm\n"
-            "- Nếu là từ rất cơ bản (a, an, the, is, are...) thì trả về nghĩa đơn giản nhất"
-        )
+        system_prompt, user_prompt = render_prompt("translate", word=word)
         
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Dịch từ: {word}"}
-            ],
-            max_tokens=50,
-            temperature=0.1  # Giảm temperature để ổn định hơn
-        )
+        response = await llm_chat("translate", system_prompt, user_prompt, template="translate")
         
         meaning = response.choices[0].message.content.strip()
         print(f"[DEBUG] /translate AI response for '{word}': {meaning}")
@@ -166,6 +1056,7 @@ async def translate_word(req: SimpleTranslateRequest):
         # Clean up the meaning
         if meaning.startswith('"') and meaning.endswith('"'):
             meaning = meaning[1:-1]
+        cache_word(word, meaning)
         
         # Create response
         hints = [TranslateHint(
@@ -194,7 +1085,9 @@ async def translate_start(req: TranslateStartRequest):
     level = req.level
     prev_history = req.prev_history if hasattr(req, 'prev_history') else []
     paragraph = req.paragraph if hasattr(req, 'paragraph') else []
-    import time
+    if OFFLINE_MODE:
+        vi_sentence = sample_corpus_sentence(topic, level, req.session_id, prev_history)
+        return {"vi_sentence": vi_sentence or "(Không có dữ liệu cho chủ đề/mức độ này)"}
     rand_seed = str(random.randint(1000,9999)) + '-' + str(int(time.time()*1000)%10000)
     history_text = '\n'.join(prev_history) if prev_history else ''
     # Nếu có đoạn song ngữ, đưa vào prompt để AI nối tiếp ngữ cảnh
@@ -207,35 +1100,28 @@ async def translate_start(req: TranslateStartRequest):
                 paragraph_text += f"{idx}. Tiếng Việt: {vi}\n   Tiếng Anh: {en}\n"
             elif vi:
                 paragraph_text += f"{idx}. Tiếng Việt: {vi}\n"
-    system_prompt = (
-        "Bạn là giáo viên tiếng Anh. Hãy tạo ra 1 câu tiếng Việt ngắn gọn, phù hợp để học sinh luyện dịch sang tiếng Anh. "
-        f"Chủ đề: {topic}. Độ khó: {level}. Câu phải tự nhiên, không quá dài, không quá dễ nếu độ khó cao. "
-        f"Không được lặp lại bất kỳ câu nào trong danh sách sau (nếu có): {history_text}. "
-        f"Nếu có đoạn hội thoại hoặc đoạn văn trước đó, hãy nối tiếp mạch nội dung, đảm bảo ngữ cảnh liền mạch. "
-        f"Đoạn trước đó (nếu có):\n{paragraph_text}"
-        f"Chỉ trả về đúng 1 câu tiếng Việt, không giải thích, không thêm gì khác. (seed: {rand_seed})"
+    system_prompt, user_prompt = render_prompt(
+        "translate_start",
+        topic=topic,
+        level=level,
+        history=history_text,
+        paragraph=paragraph_text,
+        seed=rand_seed
     )
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "Hãy cho tôi 1 câu tiếng Việt phù hợp."}
-            ],
-            max_tokens=60,
-            temperature=1.0
-        )
+        response = await llm_chat("translate_start", system_prompt, user_prompt, template="translate_start")
         vi_sentence = response.choices[0].message.content.strip()
         # Đảm bảo chỉ lấy 1 câu, không có giải thích
         if '.' in vi_sentence:
             vi_sentence = vi_sentence.split('.')[0].strip('.') + '.'
+        if not paragraph_text:
+            # Câu độc lập (không nối ngữ cảnh) mới đưa vào corpus offline
+            learn_corpus_sentence(topic, level, vi_sentence)
         return {"vi_sentence": vi_sentence}
     except Exception as e:
         # Nếu lỗi, fallback sang câu mẫu chưa xuất hiện
-        vi_list = TRANSLATE_DATA.get(topic, {}).get(level, [])
-        unused = [s for s in vi_list if s not in prev_history]
-        vi_sentence = random.choice(unused) if unused else "(Không có dữ liệu cho chủ đề/mức độ này)"
-        return {"vi_sentence": vi_sentence}
+        vi_sentence = sample_corpus_sentence(topic, level, req.session_id, prev_history)
+        return {"vi_sentence": vi_sentence or "(Không có dữ liệu cho chủ đề/mức độ này)"}
 
 @app.post("/translate/next", response_model=TranslateResponse)
 async def translate_next(req: TranslateNextRequest):
@@ -244,26 +1130,18 @@ async def translate_next(req: TranslateNextRequest):
     level = req.level
     prev_history = req.prev_history
     user_answer = req.user_answer
-    vi_list = TRANSLATE_DATA.get(topic, {}).get(level, [])
-    used = set(prev_history)
-    next_candidates = [s for s in vi_list if s not in used]
-    next_vi = random.choice(next_candidates) if next_candidates else "(Hết câu luyện tập)"
-    system_prompt = (
-        "Bạn là giáo viên tiếng Anh. Học sinh đang luyện dịch từng câu theo chủ đề. Hãy sửa câu tiếng Anh học sinh vừa trả lời, chấm điểm (thang 10), nhận xét rõ ràng, và gợi ý diễn đạt tự nhiên hơn. "
-        "Đặc biệt, hãy giải thích rõ cấu trúc ngữ pháp và thì (tense) cần sử dụng trong câu, lý do vì sao lại sửa như vậy. "
-        "Trả lời bằng JSON với 4 trường: user_answer (câu học sinh vừa trả lời), correct_answer (câu đúng), score (điểm, số hoặc chuỗi), explanation (nhận xét, giải thích, gợi ý tự nhiên, trình bày đẹp, có thể xuống dòng, dùng markdown hoặc HTML nếu cần. Đặc biệt, hãy giải thích rõ cấu trúc ngữ pháp và thì (tense) cần sử dụng trong câu, lý do vì sao lại sửa như vậy. ). Ví dụ: {\"user_answer\":..., \"correct_answer\":..., \"score\":..., \"explanation\":...}. Không thêm bất kỳ giải thích nào ngoài JSON."
+    # Frontend lấy câu tiếp theo qua /translate/start, nên ở đây chỉ xem trước, không tiêu câu của session
+    next_vi = sample_corpus_sentence(topic, level, req.session_id, prev_history, mark=False) or "(Hết câu luyện tập)"
+    system_prompt, user_prompt = render_prompt(
+        "translate_next",
+        vi_sentence=prev_history[-1] if prev_history else '',
+        user_answer=user_answer
     )
     feedback = ""
+    if OFFLINE_MODE:
+        return {"vi_sentence": next_vi, "feedback": "(Chế độ offline: không chấm điểm tự động)"}
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Câu tiếng Việt: {prev_history[-1] if prev_history else ''}\nCâu tiếng Anh học sinh trả lời: {user_answer}"}
-            ],
-            max_tokens=400,
-            temperature=0.2
-        )
+        response = await llm_chat("translate_next", system_prompt, user_prompt, template="translate_next")
         feedback = response.choices[0].message.content
         print("[DEBUG] /translate/next feedback:", feedback)
     except Exception as e:
@@ -272,31 +1150,103 @@ async def translate_next(req: TranslateNextRequest):
     print("[DEBUG] /translate/next response:", {"vi_sentence": next_vi, "feedback": feedback})
     return {"vi_sentence": next_vi, "feedback": feedback}
 
+# --- Chấm cả đoạn (batch) ---
+# Chấm nhiều câu trong 1 call có cấu trúc thay vì mỗi câu 1 call /translate/next:
+# system prompt chỉ gửi 1 lần cho cả chunk, đoạn dài được chia chunk và chấm song song.
+TRANSLATE_BATCH_CHUNK = 6
+TRANSLATE_BATCH_MAX = 40
+
+
+async def grade_translate_chunk(chunk, topic, level, lite=None):
+    """
+    Chấm 1 chunk các (index, pair); trả về dict index -> kết quả model trả về
+    """
+    import json
+    import re
+    items = "\n".join(
+        f"{idx}. Tiếng Việt: {pair.vi}\n   Học sinh: {pair.en}" for idx, pair in chunk
+    )
+    system_prompt, user_prompt = render_prompt(
+        "translate_batch", topic=topic, level=level, count=len(chunk), items=items
+    )
+    response = await llm_chat(
+        "translate_batch", system_prompt, user_prompt, bucket=len(chunk), template="translate_batch", lite=lite
+    )
+    content = response.choices[0].message.content
+    with trace_span("parse", sentences=len(chunk)):
+        match = re.search(r'(\[.*\])', content, re.DOTALL)
+        graded = json.loads(match.group(1)) if match else []
+    results = {}
+    indices = {idx for idx, _ in chunk}
+    for pos, item in enumerate(graded if isinstance(graded, list) else []):
+        if not isinstance(item, dict):
+            continue
+        try:
+            idx = int(item.get("index"))
+        except (TypeError, ValueError):
+            idx = None
+        if idx not in indices:
+            # Model bỏ index hoặc tự đánh số lại từ 1: suy theo thứ tự trong chunk
+            idx = chunk[pos][0] if pos < len(chunk) else None
+        if idx is not None:
+            results.setdefault(idx, item)
+    return results
+
+
+@app.post("/translate/batch", response_model=TranslateBatchResponse)
+async def translate_batch(req: TranslateBatchRequest):
+    pairs = req.pairs
+    if len(pairs) > TRANSLATE_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"Tối đa {TRANSLATE_BATCH_MAX} câu mỗi lần chấm")
+    results = [
+        {"index": idx, "vi_sentence": pair.vi, "user_answer": pair.en}
+        for idx, pair in enumerate(pairs, 1)
+    ]
+    # Câu bỏ trống không cần gửi lên model
+    todo = [(idx, pair) for idx, pair in enumerate(pairs, 1) if pair.vi.strip() and pair.en.strip()]
+    for res in results:
+        if not res["user_answer"].strip():
+            res.update(score="0", explanation="(Chưa trả lời)")
+        elif not res["vi_sentence"].strip():
+            # Không có câu gốc thì không có gì để chấm: báo rõ thay vì trả score rỗng
+            res["explanation"] = "(Thiếu câu tiếng Việt gốc, không chấm được)"
+    if OFFLINE_MODE:
+        for idx, _ in todo:
+            results[idx - 1]["explanation"] = "(Chế độ offline: không chấm điểm tự động)"
+        return {"results": results}
+    chunks = [todo[i:i + TRANSLATE_BATCH_CHUNK] for i in range(0, len(todo), TRANSLATE_BATCH_CHUNK)]
+    # Chọn profile 1 lần cho cả request, theo tải trước khi request này chia chunk
+    lite = use_lite_profile("translate_batch")
+    graded = await asyncio.gather(
+        *(grade_translate_chunk(chunk, req.topic, req.level, lite) for chunk in chunks),
+        return_exceptions=True
+    )
+    for chunk, outcome in zip(chunks, graded):
+        if isinstance(outcome, BaseException):
+            print("[ERROR] /translate/batch chunk:", outcome)
+        for idx, _ in chunk:
+            item = outcome.get(idx) if isinstance(outcome, dict) else None
+            if item is None:
+                error = outcome if isinstance(outcome, BaseException) else "thiếu kết quả"
+                results[idx - 1]["explanation"] = f"[Không chấm được câu này: {error}]"
+                continue
+            score = item.get("score")
+            results[idx - 1].update(
+                correct_answer=str(item.get("correct_answer") or ""),
+                score=None if score is None else str(score),
+                explanation=str(item.get("explanation") or ""),
+            )
+    return {"results": results}
+
 class ChatResponse(BaseModel):
     reply: str
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat_endpoint(chat: ChatRequest):
     user_message = chat.message
-    system_prompt = (
-        "Bạn là giáo viên tiếng Anh. Hãy sửa câu tiếng Anh của học sinh, chấm điểm (thang 10), nhận xét từng ý rõ ràng (mỗi ý xuống dòng), và cuối cùng hãy gợi ý một cách diễn đạt hay hơn, tự nhiên hơn cho câu của học sinh. "
-        "Trả lời bằng tiếng Việt. Ví dụ:"
-        "\n- Câu đúng: ..."
-        "\n- Điểm: ..."
-        "\n- Nhận xét: ..."
-        "\n- Giải thích: ..."
-        "\n- Gợi ý diễn đạt tự nhiên hơn: ..."
-    )
+    system_prompt, user_prompt = render_prompt("chat", message=user_message)
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=600,
-            temperature=0.2
-        )
+        response = await llm_chat("chat", system_prompt, user_prompt, template="chat")
         print("DEBUG reply:", response.choices[0].message.content)
         reply = response.choices[0].message.content
         return {"reply": reply}
@@ -319,39 +1269,32 @@ class HintItem(BaseModel):
     pronunciation: str = None  # Thêm phiên âm
     pos: str = None  # Thêm từ loại (part of speech)
 
+def fill_hint_pronunciations(hints):
+    # Phiên âm tra local sau khi model trả về (prompt không còn yêu cầu IPA)
+    for hint in hints:
+        if isinstance(hint, dict) and hint.get("word"):
+            hint["pronunciation"] = lookup_ipa(hint["word"]) or hint.get("pronunciation") or ""
+    return hints
+
 @app.post("/translate/hint")
 async def translate_hint(req: HintRequest):
     vi_sentence = req.vi_sentence.strip()
     if not vi_sentence:
         return {"hints": [{"info": "Không có câu để gợi ý."}]}
     # Prompt tối ưu: yêu cầu AI liệt kê từ vựng, cấu trúc ngữ pháp cần dùng để viết đúng câu tiếng Anh
-    system_prompt = (
-        "Bạn là giáo viên tiếng Anh. Hãy phân tích câu tiếng Việt sau và liệt kê các từ vựng tiếng Anh quan trọng (word), cấu trúc ngữ pháp tiếng Anh cần sử dụng (grammar) để viết đúng câu tiếng Anh tương ứng. "
-        "Mỗi gợi ý là 1 object JSON với các trường: 'word' (từ/cụm từ TIẾNG ANH), 'pos' (từ loại viết tắt: n, v, adj, adv, prep, conj, etc.), 'pronunciation' (phiên âm IPA), 'grammar' (cấu trúc TIẾNG ANH), 'vi' (giải thích ngắn gọn bằng tiếng Việt). "
-        "Ví dụ: [{\"word\": \"dolphin\", \"pos\": \"n\", \"pronunciation\": \"/ˈdɒlfɪn/\", \"vi\": \"cá heo\"}, {\"word\": \"intelligent\", \"pos\": \"adj\", \"pronunciation\": \"/ɪnˈtelɪdʒənt/\", \"vi\": \"thông minh\"}, {\"grammar\": \"be + adjective\", \"vi\": \"cấu trúc tính từ\"}]. "
-        "Nếu không có gợi ý đặc biệt, trả về mảng rỗng. Chỉ trả về JSON array, không giải thích thêm."
-    )
-    user_prompt = f"Câu tiếng Việt: {vi_sentence}\nHãy trả về JSON array như hướng dẫn."
+    system_prompt, user_prompt = render_prompt("translate_hint", vi_sentence=vi_sentence)
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=300,
-            temperature=0.2
-        )
+        response = await llm_chat("translate_hint", system_prompt, user_prompt, template="translate_hint")
         import json
         import re
         content = response.choices[0].message.content
         # Tìm đoạn JSON array trong content
-        match = re.search(r'(\[.*\])', content, re.DOTALL)
+        with trace_span("parse"):
+            match = re.search(r'(\[.*\])', content, re.DOTALL)
+            hints = json.loads(match.group(1)) if match else None
         if match:
-            arr = match.group(1)
-            hints = json.loads(arr)
             if isinstance(hints, list) and hints:
-                return {"hints": hints}
+                return {"hints": fill_hint_pronunciations(hints)}
             else:
                 return {"hints": []}
         # Nếu không có JSON array, thử parse từng dòng text
@@ -375,17 +1318,60 @@ async def translate_hint(req: HintRequest):
             else:
                 parsed.append({"info": line})
         if parsed:
-            return {"hints": parsed}
+            return {"hints": fill_hint_pronunciations(parsed)}
         return {"hints": []}
     except Exception as e:
         return {"hints": [{"info": f"[Lỗi AI]: {e}"}]}
 
+# --- Passage store ---
+# Passage do /reading/passage sinh ra được lưu theo content-hash ID cùng các kết quả phái sinh
+# (token, vocabulary, quiz, IELTS vocab) để /quiz/start và /api/ielts-vocab dùng lại thay vì tính lại.
+PASSAGE_STORE_SIZE = 500
+passage_store = OrderedDict()  # passage_id -> entry, LRU
+
+
+def passage_key(text):
+    # Chuẩn hóa khoảng trắng để textContent phía frontend vẫn khớp với passage gốc
+    normalized = " ".join(text.split())
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+
+
+def store_passage(text):
+    passage_id = passage_key(text)
+    entry = passage_store.get(passage_id)
+    if entry is None:
+        entry = {
+            "passage": text,
+            "tokens": re.findall(r'\b[a-zA-Z]+\b', text),
+            "vocabulary": None,
+            "quiz": {},  # num_questions -> questions
+            "ielts_vocab": None,
+        }
+        passage_store[passage_id] = entry
+        while len(passage_store) > PASSAGE_STORE_SIZE:
+            passage_store.popitem(last=False)
+    passage_store.move_to_end(passage_id)
+    return passage_id, entry
+
+
+def lookup_passage(passage_id=None, passage=None):
+    """
+    Tìm passage theo ID; nếu không có ID (hoặc ID đã hết hạn) thì lưu passage text gửi kèm
+    """
+    if passage_id and passage_id in passage_store:
+        passage_store.move_to_end(passage_id)
+        return passage_id, passage_store[passage_id]
+    if passage:
+        return store_passage(passage)
+    return None, None
+
 # --- Quiz API ---
 class QuizStartRequest(BaseModel):
     topic: str
     level: str
     num_questions: int = 5
     passage: str = None  # Thêm trường passage cho reading
+    passage_id: Optional[str] = None  # ID passage từ /reading/passage, thay cho gửi lại passage
 
 class QuizQuestion(BaseModel):
     question: str
@@ -450,60 +1436,143 @@ QUIZ_DATA = {
     }
 }
 
+# Quiz lớn được chia chunk QUIZ_CHUNK_SIZE câu, sinh song song; mỗi chunk nhận 1 trọng tâm khác nhau
+# để các chunk không hỏi trùng nhau, sau đó gộp lại và loại câu trùng.
+QUIZ_CHUNK_SIZE = 5
+QUIZ_FOCUS_READING = [
+    "ý chính, mục đích và bố cục của đoạn văn",
+    "chi tiết cụ thể (số liệu, tên riêng, sự kiện, nguyên nhân - kết quả)",
+    "suy luận, hàm ý và quan điểm của tác giả",
+    "từ vựng và cụm từ theo ngữ cảnh trong đoạn văn",
+]
+QUIZ_FOCUS_GENERAL = [
+    "tình huống đời sống hằng ngày",
+    "học tập và công việc",
+    "xã hội, văn hóa và môi trường",
+    "khoa học, công nghệ và sức khỏe",
+]
+# Mỗi chunk 1 trọng tâm riêng: số chunk không vượt số trọng tâm, nên quiz tối đa 4 x 5 = 20 câu
+QUIZ_MAX_PARTS = min(len(QUIZ_FOCUS_READING), len(QUIZ_FOCUS_GENERAL))
+QUIZ_MAX_QUESTIONS = QUIZ_CHUNK_SIZE * QUIZ_MAX_PARTS
+
+
+def quiz_focus(topic, part, parts):
+    """
+    Dòng trọng tâm thêm vào cuối user prompt cho chunk thứ `part` (rỗng nếu không chia chunk)
+    """
+    if parts <= 1:
+        return ""
+    focuses = QUIZ_FOCUS_READING if topic == "reading" else QUIZ_FOCUS_GENERAL
+    return (
+        f"\nĐây là phần {part + 1}/{parts} của bộ đề. Chỉ hỏi về: {focuses[part]}. "
+        "Không hỏi các khía cạnh khác để tránh trùng với các phần còn lại."
+    )
+
+
+def parse_quiz_questions(content):
+    """
+    Lấy các câu hỏi hợp lệ từ output của model; output bị cắt (max_tokens) vẫn giữ được các object đã đầy đủ
+    """
+    import json
+    start = content.find("[")
+    if start < 0:
+        return []
+    decoder = json.JSONDecoder()
+    items, pos = [], start + 1
+    while True:
+        while pos < len(content) and content[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(content) or content[pos] == "]":
+            break
+        try:
+            item, pos = decoder.raw_decode(content, pos)
+        except ValueError:
+            break
+        items.append(item)
+    questions = []
+    for q in items:
+        if not isinstance(q, dict) or not q.get("question") or not isinstance(q.get("options"), list):
+            continue
+        if isinstance(q.get("answer"), str) and q["answer"].isdigit():
+            q["answer"] = int(q["answer"])
+        if not isinstance(q.get("answer"), int) or not 0 <= q["answer"] < len(q["options"]):
+            continue
+        questions.append(q)
+    return questions
+
+
+def _question_key(question):
+    return re.sub(r"[^a-z0-9]+", " ", question.lower()).strip()
+
+
+async def generate_quiz_chunk(template, topic, size, part, parts, variables, lite=None):
+    system_prompt, user_prompt = render_prompt(
+        template, num=size, focus=quiz_focus(topic, part, parts), **variables
+    )
+    response = await llm_chat(
+        "quiz_start",
+        system_prompt,
+        user_prompt,
+        bucket=f"{usage_bucket(topic, QUIZ_DATA)}:{size}",
+        template=template,
+        lite=lite
+    )
+    content = response.choices[0].message.content
+    with trace_span("parse", part=part):
+        return parse_quiz_questions(content)
+
+
 @app.post("/quiz/start", response_model=QuizStartResponse)
 async def quiz_start(req: QuizStartRequest = Body(...)):
     topic = req.topic
     level = req.level
     num = req.num_questions
+    if not 1 <= num <= QUIZ_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"Số câu hỏi phải từ 1 đến {QUIZ_MAX_QUESTIONS}")
     passage = getattr(req, 'passage', None)
     pool = QUIZ_DATA.get(topic, {}).get(level, [])
     import random
     if pool and len(pool) >= num:
         questions = random.sample(pool, min(num, len(pool)))
         return {"questions": questions}
+    entry = None
+    if topic == "reading":
+        _, entry = lookup_passage(req.passage_id, passage)
+        if entry is not None:
+            passage = entry["passage"]
+            if entry["quiz"].get(num):
+                return {"questions": entry["quiz"][num]}
     # Nếu không đủ câu hỏi mẫu, dùng AI sinh quiz
     if topic == "reading" and passage:
-        system_prompt = (
-            f"Bạn là giáo viên luyện thi IELTS. Dưới đây là một đoạn đọc hiểu tiếng Anh (Reading passage):\n{passage}\n"
-            f"Hãy tạo ra {num} câu hỏi trắc nghiệm tiếng Anh theo phong cách đề thi IELTS (dạng Multiple Choice), sát với nội dung đoạn văn trên, cấu trúc và độ khó của đề thi IELTS thực tế. "
-            "Mỗi câu hỏi phải kiểm tra khả năng đọc hiểu, nắm ý chính, chi tiết, suy luận hoặc từ vựng trong đoạn văn. "
-            "Mỗi câu hỏi gồm: question (nội dung), options (4 đáp án), answer (chỉ số đáp án đúng, bắt đầu từ 0), explain (giải thích ngắn gọn bằng tiếng Việt, nêu lý do chọn đáp án đúng, giải thích bẫy nếu có), evidence (chỉ rõ câu hoặc đoạn trong passage liên quan trực tiếp đến đáp án đúng, chỉ trả về đúng 1 câu hoặc đoạn ngắn nhất có thể, không lặp lại toàn bộ passage). "
-            "Trả về một mảng JSON các object như sau: {question, options, answer, explain, evidence}. Không giải thích gì ngoài JSON."
-        )
+        template, variables = "quiz_reading", {"passage": passage}
     else:
-        system_prompt = (
-            f"Bạn là giáo viên luyện thi IELTS. Hãy tạo ra {num} câu hỏi trắc nghiệm tiếng Anh theo phong cách đề thi IELTS (dạng Multiple Choice), sát với nội dung, cấu trúc, và độ khó của đề thi IELTS thực tế. "
-            f"Chủ đề: {topic}. "
-            f"Yêu cầu: Độ khó, từ vựng, cấu trúc ngữ pháp, chủ đề và cách diễn đạt của từng câu hỏi phải tương ứng với band điểm IELTS {level}. "
-            "Mỗi câu hỏi nên có ngữ cảnh ngắn gọn (nếu cần), nội dung sát với đề thi IELTS (đặc biệt Reading/Listening). "
-            "Mỗi câu hỏi gồm: question (nội dung), options (4 đáp án), answer (chỉ số đáp án đúng, bắt đầu từ 0), explain (giải thích ngắn gọn bằng tiếng Việt, nêu lý do chọn đáp án đúng, giải thích bẫy nếu có). "
-            "Trả về một mảng JSON các object như sau: {question, options, answer, explain}. Không giải thích gì ngoài JSON."
-        )
-    try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Hãy sinh {num} câu hỏi quiz. Giải thích (explain) phải bằng tiếng Việt."}
-            ],
-            max_tokens=1200,
-            temperature=0.7
-        )
-        import json, re
-        content = response.choices[0].message.content
-        # Tìm đoạn JSON array trong content
-        match = re.search(r'(\[.*\])', content, re.DOTALL)
-        if match:
-            arr = match.group(1)
-            questions = json.loads(arr)
-            # Đảm bảo đúng định dạng QuizQuestion
-            for q in questions:
-                if 'answer' in q and isinstance(q['answer'], str) and q['answer'].isdigit():
-                    q['answer'] = int(q['answer'])
-            return {"questions": questions}
-        return {"questions": []}
-    except Exception as e:
-        return {"questions": []}
+        template, variables = "quiz_general", {"topic": topic, "level": level}
+    # Chia đều: 12 câu -> 4+4+4 thay vì 5+5+2
+    parts = min(QUIZ_MAX_PARTS, max(1, -(-num // QUIZ_CHUNK_SIZE)))
+    sizes = [num // parts + (1 if i < num % parts else 0) for i in range(parts)]
+    # Profile chọn 1 lần cho cả quiz: các chunk của chính request này không tự đẩy nhau sang lite
+    lite = use_lite_profile("quiz_start")
+    outcomes = await asyncio.gather(
+        *(generate_quiz_chunk(template, topic, size, part, len(sizes), variables, lite)
+          for part, size in enumerate(sizes)),
+        return_exceptions=True
+    )
+    # Gộp theo thứ tự chunk, bỏ câu trùng; chunk lỗi/bị cắt chỉ làm thiếu câu của chunk đó
+    questions, seen = [], set()
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            print("[ERROR] /quiz/start chunk:", outcome)
+            continue
+        for q in outcome:
+            key = _question_key(q["question"])
+            if key in seen:
+                continue
+            seen.add(key)
+            questions.append(q)
+    questions = questions[:num]
+    if entry is not None and len(questions) == num:
+        entry["quiz"][num] = questions
+    return {"questions": questions}
 # --- Reading Passage API ---
 class ReadingPassageRequest(BaseModel):
     level: str
@@ -511,6 +1580,145 @@ class ReadingPassageRequest(BaseModel):
 class ReadingPassageResponse(BaseModel):
     passage: str
     vocabulary: dict = {}  # Thêm từ điển nghĩa của các từ
+    passage_id: str = ""  # Dùng cho /quiz/start và /api/ielts-vocab
+
+# Bảng dữ liệu cố định cho /reading/passage: dựng 1 lần lúc import thay vì mỗi request
+# Điều chỉnh độ dài theo band điểm
+READING_WORD_COUNTS = {
+    '5.0': '80-120 từ',
+    '5.5': '100-150 từ', 
+    '6.0': '130-180 từ',
+    '6.5': '160-220 từ',
+    '7.0': '200-280 từ',
+    '7.5': '250-350 từ',
+    '8.0': '300-400 từ',
+    '8.5': '350-450 từ',
+    '9.0': '400-500 từ'
+}
+
+# Chủ đề IELTS Reading đa dạng theo band điểm - Mở rộng toàn diện
+IELTS_TOPICS_BY_BAND = {
+    # Band 1.0-3.5: Chủ đề cơ bản, quen thuộc trong đời sống hàng ngày
+    'basic': (
+        # Cuộc sống hàng ngày
+        "daily routines and lifestyle", "family and friends", "food and cooking",
+        "pets and animals", "weather and seasons", "shopping and clothes",
+        "house and home", "school life", "hobbies and free time",
+        "transportation and travel", "sports and games", "festivals and celebrations",
+        
+        # Cơ bản về công việc và sức khỏe
+        "work and jobs", "health and medicine", "numbers and time",
+        "colors and shapes", "body parts", "simple technology use",
+        
+        # Giải trí và hoạt động
+        "playground activities", "birthday parties", "weekend plans",
+        "favorite foods", "my bedroom", "visiting relatives",
+        "playing with friends", "going to the park", "watching TV",
+        
+        # Thiên nhiên và môi trường đơn giản
+        "flowers and plants", "ocean and beach", "mountains and forests",
+        "rain and sunshine", "birds and insects", "caring for plants"
+    ),
+    
+    # Band 4.0-5.5: Chủ đề thông dụng, dễ hiểu, liên quan đời sống thực tế
+    'intermediate': (
+        # Xã hội và văn hóa
+        "city life vs countryside", "popular sports and fitness", "movies and entertainment",
+        "social media and internet", "environmental problems", "healthy eating habits",
+        "education and learning", "tourism and holidays", "money and shopping",
+        "friendship and relationships", "music and art", "books and reading",
+        
+        # Công nghệ và giao tiếp
+        "computers and smartphones", "public transport", "restaurants and cafes",
+        "weekend activities", "cultural differences", "news and media",
+        "online learning", "video games", "photography",
+        
+        # Đời sống đô thị
+        "apartment living", "neighborhood community", "local markets",
+        "traffic and commuting", "recycling and waste", "volunteer work",
+        "part-time jobs", "university life", "fashion trends",
+        
+        # Sở thích và kỹ năng
+        "learning musical instruments", "cooking techniques", "gardening tips",
+        "exercise routines", "time management", "budgeting money",
+        "language exchange", "cultural festivals", "travel experiences"
+    ),
+    
+    # Band 6.0-7.0: Chủ đề phức tạp hơn, xã hội và khoa học ứng dụng
+    'advanced': (
+        # Quy hoạch và phát triển
+        "urban planning and cities", "climate change effects", "workplace trends",
+        "cultural diversity", "technology in education", "healthcare systems",
+        "sustainable living", "economic development", "social media impacts",
+        
+        # Năng lượng và môi trường
+        "renewable energy basics", "population changes", "language learning",
+        "business and marketing", "scientific discoveries", "historical events",
+        "innovation and invention", "global communication", "youth culture",
+        
+        # Tâm lý và xã hội học
+        "stress management", "work-life balance", "digital addiction",
+        "generational gaps", "consumer psychology", "urban agriculture",
+        "sustainable fashion", "food security", "mental health awareness",
+        
+        # Giáo dục và công nghệ
+        "online education trends", "artificial intelligence basics", "data privacy",
+        "startup culture", "remote working", "environmental conservation",
+        "cultural preservation", "tourism impacts", "media influence",
+        
+        # Khoa học ứng dụng
+        "medical breakthroughs", "space technology", "robotics applications",
+        "genetic research basics", "archaeological findings", "weather patterns"
+    ),
+    
+    # Band 7.5-9.0: Chủ đề academic, chuyên sâu và nghiên cứu khoa học
+    'expert': (
+        # Công nghệ tiên tiến
+        "artificial intelligence and automation", "biotechnology and genetics",
+        "quantum computing applications", "nanotechnology research",
+        "cybersecurity and digital privacy", "blockchain technology",
+        "virtual reality applications", "autonomous vehicles",
+        
+        # Khoa học tự nhiên
+        "space exploration and astronomy", "neuroscience and brain research",
+        "marine science and oceans", "geological formations",
+        "pharmaceutical research", "climate modeling",
+        "biodiversity conservation", "ecosystem dynamics",
+        
+        # Khoa học xã hội và nhân văn
+        "psychological studies", "economic theories", "political science",
+        "anthropological research", "linguistic evolution",
+        "cultural anthropology", "social psychology", "behavioral economics",
+        
+        # Nghiên cứu chuyên sâu
+        "archaeological discoveries", "historical linguistics",
+        "architectural design principles", "urban sociology",
+        "environmental engineering", "renewable vs fossil fuels",
+        "international trade policies", "demographic transitions",
+        
+        # Lĩnh vực đa ngành
+        "interdisciplinary research", "systems thinking",
+        "computational biology", "environmental economics",
+        "medical anthropology", "cognitive science",
+        "materials science", "energy policy analysis",
+        "sustainable development goals", "global governance"
+    )
+}
+
+
+# Chọn chủ đề phù hợp với band điểm
+def reading_topic_for_band(level):
+    try:
+        band_score = float(level)
+    except (TypeError, ValueError):
+        return random.choice(IELTS_TOPICS_BY_BAND['intermediate'])
+    if band_score <= 3.5:
+        return random.choice(IELTS_TOPICS_BY_BAND['basic'])
+    elif band_score <= 5.5:
+        return random.choice(IELTS_TOPICS_BY_BAND['intermediate'])
+    elif band_score <= 7.0:
+        return random.choice(IELTS_TOPICS_BY_BAND['advanced'])
+    return random.choice(IELTS_TOPICS_BY_BAND['expert'])
 
 @app.post("/reading/passage", response_model=ReadingPassageResponse)
 async def reading_passage(req: ReadingPassageRequest):
@@ -520,186 +1728,41 @@ async def reading_passage(req: ReadingPassageRequest):
     print(f"[RECEIVED LEVEL]: {level}")
     # ...existing code...
     
-    # Điều chỉnh độ dài theo band điểm
-    word_counts = {
-        '5.0': '80-120 từ',
-        '5.5': '100-150 từ', 
-        '6.0': '130-180 từ',
-        '6.5': '160-220 từ',
-        '7.0': '200-280 từ',
-        '7.5': '250-350 từ',
-        '8.0': '300-400 từ',
-        '8.5': '350-450 từ',
-        '9.0': '400-500 từ'
-    }
-    
     # Lấy độ dài tương ứng với level, mặc định medium nếu không tìm thấy
-    word_range = word_counts.get(level, '150-200 từ')
+    word_range = READING_WORD_COUNTS.get(level, '150-200 từ')
     
-    # Chủ đề IELTS Reading đa dạng theo band điểm - Mở rộng toàn diện
-    ielts_topics_by_band = {
-        # Band 1.0-3.5: Chủ đề cơ bản, quen thuộc trong đời sống hàng ngày
-        'basic': [
-            # Cuộc sống hàng ngày
-            "daily routines and lifestyle", "family and friends", "food and cooking",
-            "pets and animals", "weather and seasons", "shopping and clothes",
-            "house and home", "school life", "hobbies and free time",
-            "transportation and travel", "sports and games", "festivals and celebrations",
-            
-            # Cơ bản về công việc và sức khỏe
-            "work and jobs", "health and medicine", "numbers and time",
-            "colors and shapes", "body parts", "simple technology use",
-            
-            # Giải trí và hoạt động
-            "playground activities", "birthday parties", "weekend plans",
-            "favorite foods", "my bedroom", "visiting relatives",
-            "playing with friends", "going to the park", "watching TV",
-            
-            # Thiên nhiên và môi trường đơn giản
-            "flowers and plants", "ocean and beach", "mountains and forests",
-            "rain and sunshine", "birds and insects", "caring for plants"
-        ],
-        
-        # Band 4.0-5.5: Chủ đề thông dụng, dễ hiểu, liên quan đời sống thực tế
-        'intermediate': [
-            # Xã hội và văn hóa
-            "city life vs countryside", "popular sports and fitness", "movies and entertainment",
-            "social media and internet", "environmental problems", "healthy eating habits",
-            "education and learning", "tourism and holidays", "money and shopping",
-            "friendship and relationships", "music and art", "books and reading",
-            
-            # Công nghệ và giao tiếp
-            "computers and smartphones", "public transport", "restaurants and cafes",
-            "weekend activities", "cultural differences", "news and media",
-            "online learning", "video games", "photography",
-            
-            # Đời sống đô thị
-            "apartment living", "neighborhood community", "local markets",
-            "traffic and commuting", "recycling and waste", "volunteer work",
-            "part-time jobs", "university life", "fashion trends",
-            
-            # Sở thích và kỹ năng
-            "learning musical instruments", "cooking techniques", "gardening tips",
-            "exercise routines", "time management", "budgeting money",
-            "language exchange", "cultural festivals", "travel experiences"
-        ],
-        
-        # Band 6.0-7.0: Chủ đề phức tạp hơn, xã hội và khoa học ứng dụng
-        'advanced': [
-            # Quy hoạch và phát triển
-            "urban planning and cities", "climate change effects", "workplace trends",
-            "cultural diversity", "technology in education", "healthcare systems",
-            "sustainable living", "economic development", "social media impacts",
-            
-            # Năng lượng và môi trường
-            "renewable energy basics", "population changes", "language learning",
-            "business and marketing", "scientific discoveries", "historical events",
-            "innovation and invention", "global communication", "youth culture",
-            
-            # Tâm lý và xã hội học
-            "stress management", "work-life balance", "digital addiction",
-            "generational gaps", "consumer psychology", "urban agriculture",
-            "sustainable fashion", "food security", "mental health awareness",
-            
-            # Giáo dục và công nghệ
-            "online education trends", "artificial intelligence basics", "data privacy",
-            "startup culture", "remote working", "environmental conservation",
-            "cultural preservation", "tourism impacts", "media influence",
-            
-            # Khoa học ứng dụng
-            "medical breakthroughs", "space technology", "robotics applications",
-            "genetic research basics", "archaeological findings", "weather patterns"
-        ],
-        
-        # Band 7.5-9.0: Chủ đề academic, chuyên sâu và nghiên cứu khoa học
-        'expert': [
-            # Công nghệ tiên tiến
-            "artificial intelligence and automation", "biotechnology and genetics",
-            "quantum computing applications", "nanotechnology research",
-            "cybersecurity and digital privacy", "blockchain technology",
-            "virtual reality applications", "autonomous vehicles",
-            
-            # Khoa học tự nhiên
-            "space exploration and astronomy", "neuroscience and brain research",
-            "marine science and oceans", "geological formations",
-            "pharmaceutical research", "climate modeling",
-            "biodiversity conservation", "ecosystem dynamics",
-            
-            # Khoa học xã hội và nhân văn
-            "psychological studies", "economic theories", "political science",
-            "anthropological research", "linguistic evolution",
-            "cultural anthropology", "social psychology", "behavioral economics",
-            
-            # Nghiên cứu chuyên sâu
-            "archaeological discoveries", "historical linguistics",
-            "architectural design principles", "urban sociology",
-            "environmental engineering", "renewable vs fossil fuels",
-            "international trade policies", "demographic transitions",
-            
-            # Lĩnh vực đa ngành
-            "interdisciplinary research", "systems thinking",
-            "computational biology", "environmental economics",
-            "medical anthropology", "cognitive science",
-            "materials science", "energy policy analysis",
-            "sustainable development goals", "global governance"
-        ]
-    }
-    
-    # Chọn chủ đề phù hợp với band điểm
-    def get_topic_by_band(level):
-        try:
-            band_score = float(level)
-            if band_score <= 3.5:
-                return random.choice(ielts_topics_by_band['basic'])
-            elif band_score <= 5.5:
-                return random.choice(ielts_topics_by_band['intermediate'])
-            elif band_score <= 7.0:
-                return random.choice(ielts_topics_by_band['advanced'])
-            else:
-                return random.choice(ielts_topics_by_band['expert'])
-        except:
-            return random.choice(ielts_topics_by_band['intermediate'])
+    selected_topic = reading_topic_for_band(level)
     
-    import random
-    selected_topic = get_topic_by_band(level)
-    
-    system_prompt = (
-        f"Bạn là Cambridge IELTS examiner. Hãy tạo Reading passage theo chuẩn IELTS Academic, độ dài {word_range}.\n"
-        f"Chủ đề: {selected_topic}\n"
-        f"Band điểm: {level}\n\n"
-        "YÊU CẦU THEO BAND ĐIỂM:\n"
-        f"- Band 1.0-3.5: Văn bản đơn giản, từ vựng cơ bản, câu ngắn, chủ đề quen thuộc hàng ngày\n"
-        f"- Band 4.0-5.5: Văn bản trung bình, từ vựng thông dụng, cấu trúc câu đơn giản, chủ đề thực tế\n" 
-        f"- Band 6.0-7.0: Văn bản phức tạp hơn, từ vựng đa dạng, câu ghép, chủ đề xã hội\n"
-        f"- Band 7.5-9.0: Văn phong academic, từ vựng chuyên môn, câu phức, chủ đề khoa học\n\n"
-        "ĐIỀU CHỈNH THEO LEVEL:\n"
-        f"- Độ khó từ vựng phù hợp band {level}\n"
-        f"- Cấu trúc câu phù hợp band {level}\n"
-        f"- Độ phức tạp nội dung phù hợp band {level}\n"
-        f"- Giọng văn phù hợp band {level} (đơn giản → academic)\n\n"
-        "Format: Đoạn văn liền mạch, có đầu - giữa - cuối rõ ràng.\n"
-        f"Chỉ trả về passage tiếng Anh, độ dài {word_range}, không giải thích."
+    system_prompt, user_prompt = render_prompt(
+        "reading_passage",
+        topic=selected_topic,
+        level=level,
+        word_range=word_range
     )
     print("[DEBUG] /reading/passage request level:", level)
-    print("[DEBUG] /reading/passage system_prompt:", system_prompt)
+    print("[DEBUG] /reading/passage user_prompt:", user_prompt)
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "Hãy viết đoạn đọc hiểu IELTS."}
-            ],
-            max_tokens=700,  # Tăng từ 300 lên 700 để xử lý đoạn văn dài hơn
-            temperature=0.8
+        # Độ dài passage phụ thuộc band nên thống kê usage tách theo level
+        response = await llm_chat(
+            "reading_passage",
+            system_prompt,
+            user_prompt,
+            bucket=usage_bucket(level, READING_WORD_COUNTS),
+            template="reading_passage"
         )
         passage = response.choices[0].message.content.strip()
         print("[DEBUG] /reading/passage AI response:", passage)
         
+        passage_id, entry = store_passage(passage)
+        
         # Tạo vocabulary meanings cho passage
-        vocabulary = await generate_vocabulary_meanings(passage)
+        if entry["vocabulary"] is None:
+            with trace_span("vocabulary_meanings"):
+                entry["vocabulary"] = await generate_vocabulary_meanings(passage, entry["tokens"])
+        vocabulary = entry["vocabulary"]
         print("[DEBUG] /reading/passage vocabulary:", vocabulary)
         
-        return {"passage": passage, "vocabulary": vocabulary}
+        return {"passage": passage, "vocabulary": vocabulary, "passage_id": passage_id}
     except Exception as e:
         print("[ERROR] /reading/passage Exception:", e)
         traceback.print_exc()
@@ -723,21 +1786,10 @@ async def generate_listening(req: ListeningRequest):
     print(f"[RECEIVED TOPIC]: {topic}")
     print(f"[RECEIVED BAND]: {band}")
     # Prompt cho AI sinh câu luyện nghe
-    system_prompt = (
-        f"Bạn là giáo viên luyện thi IELTS. Hãy tạo ra 1 câu tiếng Anh phù hợp để luyện nghe, sát với đề thi IELTS Listening, chủ đề: {topic}, band điểm: {band}. "
-        "Câu phải tự nhiên, không quá dài, không quá dễ nếu band cao. Trả về đúng 1 câu tiếng Anh, không giải thích, không thêm gì khác."
-    )
-    print("[DEBUG] /api/generate-listening system_prompt:", system_prompt)
+    system_prompt, user_prompt = render_prompt("listening", topic=topic, band=band)
+    print("[DEBUG] /api/generate-listening user_prompt:", user_prompt)
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "Hãy cho tôi 1 câu tiếng Anh phù hợp để luyện nghe."}
-            ],
-            max_tokens=60,
-            temperature=1.0
-        )
+        response = await llm_chat("listening", system_prompt, user_prompt, template="listening")
         text = response.choices[0].message.content.strip()
         answer = text
         print("[DEBUG] /api/generate-listening AI response:", text)
@@ -759,7 +1811,8 @@ async def get_listening_info():
 # --- IELTS Vocabulary Extraction API ---
 from fastapi import Request
 class IELTSVocabRequest(BaseModel):
-    passage: str
+    passage: Optional[str] = None
+    passage_id: Optional[str] = None
     level: Optional[str] = None
 
 class IELTSVocabWord(BaseModel):
@@ -775,33 +1828,21 @@ class IELTSVocabResponse(BaseModel):
 
 @app.post("/api/ielts-vocab", response_model=IELTSVocabResponse)
 async def ielts_vocab(req: IELTSVocabRequest):
-    passage = req.passage
+    _, entry = lookup_passage(req.passage_id, req.passage)
+    if entry is None:
+        return {"vocab": []}
+    if entry["ielts_vocab"] is not None:
+        return {"vocab": entry["ielts_vocab"]}
+    passage = entry["passage"]
     level = req.level or "all"
-    system_prompt = (
-        "Bạn là giáo viên luyện thi IELTS. Dưới đây là một đoạn đọc hiểu tiếng Anh (Reading passage):\n" + passage + "\n"
-        "Hãy phân tích đoạn văn trên và chỉ trích xuất các từ vựng thực sự phổ biến trong kỳ thi IELTS (high-frequency IELTS vocabulary, academic word list, hoặc các từ thường xuất hiện trong đề thi IELTS band 5-9). "
-        "Bỏ qua các từ thông dụng, từ không phải từ vựng học thuật IELTS. Không chọn các từ như: the, and, is, are, have, do, go, come, get, make, take, see, say, can, will, should, must, may, might, would, could, shall, to, of, in, on, at, for, with, by, from, as, but, or, if, so, because, very, really, just, only, also, too, more, most, much, many, some, any, every, each, all, no, not, nor, neither, either, both, few, little, less, least, enough, again, always, never, sometimes, often, usually, rarely, seldom, ever, never, before, after, then, now, soon, later, today, tomorrow, yesterday, here, there, where, when, why, how, what, which, who, whom, whose, this, that, these, those, I, you, he, she, it, we, they, me, him, her, us, them, my, your, his, her, its, our, their, mine, yours, hers, ours, theirs, a, an. "
-        "Chỉ chọn các từ academic, collocation, hoặc technical thường gặp trong đề IELTS. "
-        "Với mỗi từ vựng, hãy trả về thông tin sau: word (từ), meaning (nghĩa tiếng Việt), part_of_speech (loại từ), phonetic (phiên âm IPA), example (ví dụ sử dụng từ trong ngữ cảnh đoạn văn), analysis (giải thích ngắn gọn về ý nghĩa/ngữ cảnh sử dụng từ trong đoạn). "
-        "Chỉ trả về một mảng JSON các object như sau: {word, meaning, part_of_speech, phonetic, example, analysis}. Không giải thích gì ngoài JSON."
-    )
+    system_prompt, user_prompt = render_prompt("ielts_vocab", passage=passage)
     try:
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": "Hãy trích xuất từ vựng IELTS từ đoạn văn trên."}
-            ],
-            max_tokens=1200,
-            temperature=0.7
-        )
+        response = await llm_chat("ielts_vocab", system_prompt, user_prompt, template="ielts_vocab")
         import json, re
         content = response.choices[0].message.content
-        match = re.search(r'(\[.*\])', content, re.DOTALL)
-        vocab_list = []
-        if match:
-            arr = match.group(1)
-            vocab_list = json.loads(arr)
+        with trace_span("parse"):
+            match = re.search(r'(\[.*\])', content, re.DOTALL)
+            vocab_list = json.loads(match.group(1)) if match else []
         # Chuyển đổi sang định dạng chuẩn
         result = []
         for v in vocab_list:
@@ -809,28 +1850,33 @@ async def ielts_vocab(req: IELTSVocabRequest):
                 "word": v.get("word", ""),
                 "meaning": v.get("meaning", ""),
                 "part_of_speech": v.get("part_of_speech", ""),
-                "phonetic": v.get("phonetic", ""),
+                "phonetic": lookup_ipa(v.get("word", "")),
                 "example": v.get("example", ""),
                 "analysis": v.get("analysis", "")
             })
+        if result:
+            entry["ielts_vocab"] = result
+            for v in result:
+                cache_word(v["word"], v["meaning"], v["part_of_speech"], v["example"])
         return {"vocab": result}
     except Exception as e:
         return {"vocab": []}
 
 # Helper function để tạo vocabulary meanings cho reading passage
-async def generate_vocabulary_meanings(passage: str) -> dict:
+async def generate_vocabulary_meanings(passage: str, words: Optional[List[str]] = None) -> dict:
     """
-    Tạo từ điển nghĩa của các từ trong passage theo ngữ cảnh
+    Tạo từ điển nghĩa của các từ trong passage theo ngữ cảnh (words: token đã tách sẵn, nếu có)
     """
     import re
     import json
     
     try:
         # Extract ALL words from passage - không filter gì cả
-        words = re.findall(r'\b[a-zA-Z]+\b', passage)
+        if words is None:
+            words = re.findall(r'\b[a-zA-Z]+\b', passage)
         
-        # Lấy tất cả từ unique, giữ nguyên case gốc
-        all_words = list(set(words))
+        # Lấy tất cả từ unique, giữ nguyên case gốc (sắp xếp để prompt ổn định giữa các lần gọi)
+        all_words = sorted(set(words))
         
         if not all_words:
             return {}
@@ -841,27 +1887,20 @@ async def generate_vocabulary_meanings(passage: str) -> dict:
         # Gọi AI để dịch TẤT CẢ từ trong passage
         words_str = ', '.join(all_words)
         
-        system_prompt = (
-            f"Bạn là từ điển Cambridge Dictionary chuyên nghiệp. Đoạn văn:\n\n{passage}\n\n"
-            f"Dịch CHÍNH XÁC {len(all_words)} từ sau sang tiếng Việt theo ngữ cảnh:\n{words_str}\n\n"
-            "QUAN TRỌNG: JSON phải có ĐÚNG {len(all_words)} entries, không được thiếu!\n\n"
-            "Format: {{\"word1\":\"nghĩa\", \"word2\":\"nghĩa\", ...}}\n\n"
-            "Quy tắc dịch:\n"
-            "- Từ nội dung: dịch theo nghĩa chính xác trong ngữ cảnh\n"
-            "- Từ ngữ pháp (the, and, is, are...): dịch nghĩa đơn giản nhất\n"
-            "- Nghĩa ngắn gọn 1-3 từ\n"
-            "- Bắt buộc phải có đủ tất cả từ trong response\n"
-            "- Chỉ trả JSON, không giải thích"
+        system_prompt, user_prompt = render_prompt(
+            "vocabulary_meanings",
+            passage=passage,
+            count=len(all_words),
+            words=words_str
         )
         
-        response = client.chat.completions.create(
-            model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": f"Dịch tất cả {len(all_words)} từ trong đoạn văn."}
-            ],
-            max_tokens=1500,  # Tăng từ 1000 lên 1500 để đảm bảo dịch đủ từ
-            temperature=0.05  # Giảm temperature để AI consistent hơn
+        # Số token đầu ra tỉ lệ với số từ cần dịch -> thống kê theo nhóm 25 từ
+        response = await llm_chat(
+            "vocabulary_meanings",
+            system_prompt,
+            user_prompt,
+            bucket=len(all_words) // 25,
+            template="vocabulary_meanings"
         )
         
         ai_response = response.choices[0].message.content.strip()
@@ -869,7 +1908,8 @@ async def generate_vocabulary_meanings(passage: str) -> dict:
         
         # Parse JSON response
         try:
-            vocabulary_dict = json.loads(ai_response)
+            with trace_span("parse"):
+                vocabulary_dict = json.loads(ai_response)
             
             # Log coverage statistics
             provided_words = len(vocabulary_dict)
@@ -877,6 +1917,9 @@ async def generate_vocabulary_meanings(passage: str) -> dict:
             coverage = (provided_words / requested_words) * 100 if requested_words > 0 else 0
             
             print(f"[DEBUG] Vocabulary coverage: {provided_words}/{requested_words} words ({coverage:.1f}%)")
+            # Nghĩa theo ngữ cảnh passage: chỉ bổ sung từ chưa có, không ghi đè nghĩa đã tra
+            for w, meaning in vocabulary_dict.items():
+                cache_word(w, meaning, overwrite=False)
             
             if coverage < 80:  # If coverage is poor, log missing words
                 missing_words = [word for word in all_words if word not in vocabulary_dict]
@@ -890,7 +1933,8 @@ async def generate_vocabulary_meanings(passage: str) -> dict:
             json_match = re.search(r'\{.*\}', ai_response, re.DOTALL)
             if json_match:
                 try:
-                    vocabulary_dict = json.loads(json_match.group())
+                    with trace_span("parse_fallback"):
+                        vocabulary_dict = json.loads(json_match.group())
                     print(f"[DEBUG] Extracted JSON from markdown response")
                     return vocabulary_dict
                 except json.JSONDecodeError:
@@ -903,6 +1947,345 @@ async def generate_vocabulary_meanings(passage: str) -> dict:
         print(f"[ERROR] generate_vocabulary_meanings: {e}")
         return {}
 
+# --- Learner progress ---
+# Tiến độ học lưu phía server theo learner_id (client tự sinh và giữ trong localStorage).
+# Mỗi learner là 1 record nhỏ (__slots__): vài bộ đếm + các từ cần ôn word -> [box, due, lapses, seen].
+# Lịch ôn kiểu Leitner: đúng thì lên box (giãn cách dài hơn), sai thì về box 0. Hàng đợi ôn là
+# heap (due, word) nên lên lịch 1 từ tốn O(log n); entry cũ trong heap bị bỏ qua khi pop.
+# Record được ghi ngay vào sqlite (RUNTIME_DATA_DIR/progress.db) sau mỗi thay đổi nên không mất khi
+# restart; RAM chỉ giữ LRU các learner gần đây. Cột version cho biết worker khác đã ghi chen giữa.
+import heapq
+import json
+import sqlite3
+import sys
+from datetime import date
+
+PROGRESS_DB_PATH = os.path.join(RUNTIME_DATA_DIR, "progress.db")
+PROGRESS_MAX_LEARNERS = 50000  # số learner giữ trong RAM; bản đầy đủ nằm trong sqlite
+PROGRESS_MAX_WORDS = 2000
+PROGRESS_SAVE_RETRIES = 3
+REVIEW_INTERVALS = (600, 86400, 3 * 86400, 7 * 86400, 16 * 86400, 35 * 86400)  # giây, theo box
+REVIEW_SET_SIZE = 10
+REVIEW_CORRECT_SCORE = 7  # điểm chấm dịch (thang 10) từ mức này tính là đúng
+
+
+class LearnerProgress:
+    __slots__ = ("sessions", "answered", "correct", "streak", "last_day", "words", "due", "version")
+
+    def __init__(self):
+        self.sessions = 0
+        self.answered = 0
+        self.correct = 0
+        self.streak = 0
+        self.last_day = 0  # date.toordinal() của ngày học gần nhất
+        self.words = {}  # word -> [box, due (epoch giây), lapses, seen (epoch giây)]
+        self.due = []  # heap (due, word)
+        self.version = 0  # version của bản trong sqlite; 0 = chưa lưu lần nào
+
+
+learners = OrderedDict()  # learner_id -> LearnerProgress, LRU
+progress_conn = None
+
+
+def progress_db():
+    global progress_conn
+    if progress_conn is None:
+        os.makedirs(RUNTIME_DATA_DIR, exist_ok=True)
+        conn = sqlite3.connect(PROGRESS_DB_PATH, isolation_level=None, check_same_thread=False)
+        # WAL + busy_timeout: nhiều worker đọc/ghi cùng file mà không báo "database is locked"
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS learners (id TEXT PRIMARY KEY, version INTEGER NOT NULL, "
+            "sessions INTEGER, answered INTEGER, correct INTEGER, streak INTEGER, last_day INTEGER, words TEXT)"
+        )
+        progress_conn = conn
+    return progress_conn
+
+
+def load_learner(learner_id):
+    row = progress_db().execute(
+        "SELECT version, sessions, answered, correct, streak, last_day, words FROM learners WHERE id = ?",
+        (learner_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    rec = LearnerProgress()
+    rec.version, rec.sessions, rec.answered, rec.correct, rec.streak, rec.last_day = row[:6]
+    rec.words = {sys.intern(word): item for word, item in json.loads(row[6]).items()}
+    rec.due = [(item[1], word) for word, item in rec.words.items()]
+    heapq.heapify(rec.due)
+    return rec
+
+
+def get_learner(learner_id, create=True):
+    rec = learners.get(learner_id)
+    if rec is not None and rec.version:
+        # Worker khác có thể vừa ghi record này: lệch version thì nạp lại từ sqlite
+        row = progress_db().execute("SELECT version FROM learners WHERE id = ?", (learner_id,)).fetchone()
+        if row is None or row[0] != rec.version:
+            rec = None
+    if rec is None:
+        rec = load_learner(learner_id)
+        if rec is None:
+            if not create:
+                return None
+            rec = LearnerProgress()
+        learners[learner_id] = rec
+        while len(learners) > PROGRESS_MAX_LEARNERS:
+            learners.popitem(last=False)  # chỉ bỏ khỏi RAM, bản trong sqlite vẫn còn
+    learners.move_to_end(learner_id)
+    return rec
+
+
+def save_learner(learner_id, rec):
+    """
+    Ghi record vào sqlite; False nếu worker khác đã ghi chen giữa (version lệch)
+    """
+    values = (rec.sessions, rec.answered, rec.correct, rec.streak, rec.last_day,
+              json.dumps(rec.words, separators=(",", ":")))
+    if rec.version == 0:
+        cur = progress_db().execute(
+            "INSERT OR IGNORE INTO learners VALUES (?, 1, ?, ?, ?, ?, ?, ?)", (learner_id, *values)
+        )
+    else:
+        cur = progress_db().execute(
+            "UPDATE learners SET version = version + 1, sessions = ?, answered = ?, correct = ?, "
+            "streak = ?, last_day = ?, words = ? WHERE id = ? AND version = ?",
+            (*values, learner_id, rec.version)
+        )
+    if cur.rowcount != 1:
+        learners.pop(learner_id, None)
+        return False
+    rec.version += 1
+    return True
+
+
+def update_learner(learner_id, apply):
+    """
+    Chạy apply(rec) rồi lưu; bị worker khác ghi chen thì nạp lại và chạy lại.
+    apply trả về False nếu không có gì thay đổi (khỏi ghi)
+    """
+    rec = None
+    try:
+        for _ in range(PROGRESS_SAVE_RETRIES):
+            rec = get_learner(learner_id)
+            if apply(rec) is False or save_learner(learner_id, rec):
+                return rec
+        print("[ERROR] update_learner: ghi tiến độ bị xung đột liên tục:", learner_id)
+    except sqlite3.Error as e:
+        print("[ERROR] update_learner:", e)
+    return rec
+
+
+def touch_streak(rec):
+    today = date.today().toordinal()
+    if rec.last_day != today:
+        rec.streak = rec.streak + 1 if rec.last_day == today - 1 else 1
+        rec.last_day = today
+
+
+def schedule_word(rec, word, correct=None):
+    """
+    Lên lịch ôn 1 từ: correct=None khi vừa tra từ, True/False là kết quả ôn tập
+    """
+    word = sys.intern(word.strip().lower())  # cùng 1 chuỗi dùng chung giữa các learner
+    if not word:
+        return False
+    now = int(time.time())
+    item = rec.words.get(word)
+    if item is None:
+        if len(rec.words) >= PROGRESS_MAX_WORDS:
+            evict_word(rec)
+        item = rec.words[word] = [0, 0, 0, now]
+    elif correct is None:
+        return False  # tra lại từ đã có lịch: giữ nguyên
+    if correct:
+        item[0] = min(item[0] + 1, len(REVIEW_INTERVALS) - 1)
+    elif correct is False:
+        item[0] = 0
+        item[2] += 1
+    item[1] = now + REVIEW_INTERVALS[item[0]]
+    item[3] = now
+    heapq.heappush(rec.due, (item[1], word))
+    if len(rec.due) > 2 * len(rec.words) + 32:
+        # Dọn entry cũ để heap không phình theo số lần ôn
+        rec.due = [(item[1], w) for w, item in rec.words.items()]
+        heapq.heapify(rec.due)
+    return True
+
+
+def evict_word(rec):
+    # Đầy: bỏ từ đã thuộc (box cao nhất) lâu nhất không gặp; chưa có từ nào thuộc thì bỏ từ lâu nhất
+    # không gặp. Entry của nó trong heap thành entry cũ, due_words tự bỏ qua.
+    top = len(REVIEW_INTERVALS) - 1
+    word = min(rec.words, key=lambda w: (rec.words[w][0] != top, rec.words[w][3]))
+    del rec.words[word]
+
+
+def due_words(rec, limit):
+    """
+    Tối đa `limit` từ đã đến hạn (hạn sớm nhất trước) và có sẵn nghĩa trong word_cache
+    """
+    now = time.time()
+    picked, popped = [], []
+    while rec.due and rec.due[0][0] <= now and len(picked) < limit:
+        due, word = heapq.heappop(rec.due)
+        item = rec.words.get(word)
+        if item is None or item[1] != due:
+            continue  # entry cũ
+        popped.append((due, word))
+        if cached_word(word):
+            picked.append(word)
+    # Từ chưa ôn xong vẫn đến hạn: trả lại heap
+    for entry in popped:
+        heapq.heappush(rec.due, entry)
+    return picked
+
+
+def progress_summary(rec):
+    now = time.time()
+    active = rec.last_day >= date.today().toordinal() - 1
+    return {
+        "sessionCount": rec.sessions,
+        "accuracyRate": f"{round(100 * rec.correct / rec.answered)}%" if rec.answered else "0%",
+        "dailyStreak": rec.streak if active else 0,
+        "words": len(rec.words),
+        "due": sum(1 for item in rec.words.values() if item[1] <= now),
+    }
+
+
+class ProgressEvent(BaseModel):
+    kind: str  # "session" | "answer" | "review"
+    correct: Optional[bool] = None
+    score: Optional[float] = None  # điểm chấm dịch, thay cho correct nếu có
+    word: Optional[str] = None
+
+class ProgressEventsRequest(BaseModel):
+    learner_id: str
+    events: List[ProgressEvent]
+
+class ReviewItem(BaseModel):
+    word: str
+    meaning: str
+    part_of_speech: str = ""
+    phonetic: str = ""
+    example: str = ""
+    box: int = 0
+
+class ReviewResponse(BaseModel):
+    items: List[ReviewItem]
+
+@app.post("/api/progress/events")
+async def record_progress(req: ProgressEventsRequest):
+    def apply(rec):
+        for event in req.events:
+            correct = event.correct
+            if event.score is not None:
+                correct = event.score >= REVIEW_CORRECT_SCORE
+            if event.kind == "session":
+                rec.sessions += 1
+                touch_streak(rec)
+            elif event.kind == "answer" and correct is not None:
+                rec.answered += 1
+                rec.correct += int(correct)
+                touch_streak(rec)
+            elif event.kind == "review" and event.word and correct is not None:
+                schedule_word(rec, event.word, correct)
+                touch_streak(rec)
+    return progress_summary(update_learner(req.learner_id, apply))
+
+@app.get("/api/progress/{learner_id}")
+async def get_progress(learner_id: str):
+    # 404 khi server chưa có record: client giữ số liệu local thay vì bị ghi đè bằng 0
+    rec = get_learner(learner_id, create=False)
+    if rec is None:
+        raise HTTPException(status_code=404, detail="Chưa có tiến độ cho learner này")
+    return progress_summary(rec)
+
+@app.get("/api/progress/{learner_id}/review", response_model=ReviewResponse)
+async def get_review_set(learner_id: str, limit: int = REVIEW_SET_SIZE):
+    # Bộ ôn tập dựng hoàn toàn từ word_cache + từ điển IPA, không gọi model
+    rec = get_learner(learner_id, create=False)
+    if rec is None:
+        return {"items": []}
+    items = []
+    for word in due_words(rec, max(1, min(limit, 50))):
+        data = cached_word(word)
+        items.append({
+            "word": word,
+            "meaning": data["meaning"],
+            "part_of_speech": data["part_of_speech"],
+            "phonetic": lookup_ipa(word),
+            "example": data["example"],
+            "box": rec.words[word][0],
+        })
+    return {"items": items}
+
+# --- Startup / readiness ---
+# Import chỉ dựng những gì cần để nhận request; client, corpus và từ điển IPA được nạp lazy
+# hoặc làm nóng nền ngay sau startup. /api/ready cho biết khi nào các cache đã sẵn sàng.
+IMPORT_TIME_BUDGET_MS = float(os.getenv("IMPORT_TIME_BUDGET_MS", "250"))
+startup_stats = {"import_ms": None, "warm_ms": None, "started_at": time.time()}
+
+
+async def warm_caches():
+    started = time.perf_counter()
+    try:
+        ensure_translate_corpus()
+        await asyncio.sleep(0)
+        ensure_ipa_dict()
+        progress_db()
+        # import openai + dựng client ở thread riêng để không chặn event loop
+        await asyncio.to_thread(get_client)
+    except Exception as e:
+        print("[ERROR] warm_caches:", e)
+        return
+    startup_stats["warm_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"[DEBUG] Caches warm in {startup_stats['warm_ms']} ms")
+
+
+def readiness():
+    checks = {
+        "client": client is not None,
+        "translate_corpus": corpus_loaded,
+        "ipa_dict": ipa_loaded,
+        "progress_db": progress_conn is not None,
+    }
+    return {
+        "ready": all(checks.values()),
+        "checks": checks,
+        "import_ms": startup_stats["import_ms"],
+        "warm_ms": startup_stats["warm_ms"],
+        "uptime_s": round(time.time() - startup_stats["started_at"], 1),
+        "caches": {
+            "corpus_sentences": len(corpus_sentences),
+            "ipa_words": len(ipa_dict),
+            "word_cache": len(word_cache),
+            "passages": len(passage_store),
+            "learners": len(learners),
+            "tuned_buckets": sum(1 for samples in llm_usage.values() if len(samples) >= LLM_USAGE_MIN_SAMPLES),
+        },
+    }
+
+
+@app.get("/api/ready")
+async def ready_endpoint():
+    # 503 cho tới khi warm-up xong, để load balancer / launcher chờ trước khi chuyển traffic
+    state = readiness()
+    return JSONResponse(state, status_code=200 if state["ready"] else 503)
+
+
+startup_stats["import_ms"] = round((time.perf_counter() - _import_started) * 1000, 1)
+if startup_stats["import_ms"] > IMPORT_TIME_BUDGET_MS:
+    print(f"[WARNING] main.py import mất {startup_stats['import_ms']} ms, vượt ngân sách {IMPORT_TIME_BUDGET_MS:.0f} ms "
+          "(kiểm tra bằng: python -X importtime -c \"import main\")")
+
 if __name__ == "__main__":
+    import sys
+    if "--check-import-time" in sys.argv:
+        # Dùng trong CI / trước khi đóng gói exe: exit 1 nếu import chậm hơn ngân sách
+        print(f"import: {startup_stats['import_ms']} ms (budget {IMPORT_TIME_BUDGET_MS:.0f} ms)")
+        sys.exit(0 if startup_stats["import_ms"] <= IMPORT_TIME_BUDGET_MS else 1)
     import uvicorn
     uvicorn.run(app, host="127.0.0.1", port=8000)